@@ -0,0 +1,45 @@
+"""
+Micro-benchmark of the MQTT payload decoders.
+
+Run from the repository root:
+    python benchmarks/wire_format.py
+"""
+import os
+import sys
+import json
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.utils import *
+
+
+N = 100_000
+
+data = TransferData(grid=-1250, PV=3400, load=4650, status="RELAY_ON",
+                    voltage=231.4, frequency=50.01, temperature=41.5,
+                    PV_energy=12_345_678, export_energy=4_567_890,
+                    import_energy=2_345_678, inverter_status=4)
+
+json_payload = encode_transfer_data(data, "json")
+binary_payload = encode_transfer_data(data, "binary")
+
+
+def legacy():
+    """
+    The original decode path: bytes -> str -> dict -> TransferData.
+    """
+    return TransferData(**json.loads(json_payload.decode()))
+
+
+cases = {
+    "legacy json": legacy,
+    "json": lambda: decode_transfer_data(json_payload, "json"),
+    "binary": lambda: decode_transfer_data(binary_payload, "binary"),
+}
+
+print(f"payload size: json {len(json_payload)} B, "
+      f"binary {len(binary_payload)} B")
+
+for name, func in cases.items():
+    t = min(timeit.repeat(func, number=N, repeat=3))
+    print(f"{name:>12}: {N / t:>10.0f} msg/s  {1e6 * t / N:6.2f} us/msg")
@@ -1,2 +1,3 @@
 from lib.utils import *
-from lib.mode import Standalone, Publisher, Subscriber, BaseMode, TaskManager
\ No newline at end of file
+from lib.mode import Standalone, Publisher, Subscriber, BaseMode, TaskManager, SUBPROTOCOLS
+from lib.metrics import LATENCY, MetricsWriter
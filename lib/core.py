@@ -7,84 +7,228 @@ from typing import Union
 import paho.mqtt.client as mqtt
 from gpiozero import DigitalOutputDevice
 from collections.abc import Callable
+from collections import deque
 import sys
+import os
+from array import array
+from bisect import bisect_right
+from datetime import date, timedelta
 
 from lib.utils import *
+from lib.sunspec import INVERTER, METER, plan_reads
+from lib.storage import SampleStore, RingBuffer
+from lib.metrics import observe_latency, Histogram, MetricsWriter
+from lib.scheduler import Scheduler, Job
 
 
 
 class TimeBlock:
+    """
+    Tariff block lookup compiled from a TariffConfig. Every year is turned
+    into a table of block ids per local hour, so the current block and the
+    next change are O(1).
+    """
+    def __init__(self, tariff: TariffConfig):
+        """
+        Compile the tariff and build the table of the current year. Raises
+        ValueError if the tariff is inconsistent.
 
-    TIME_ZONE = (
-        (0, 6),
-        (6, 7),
-        (7, 14),
-        (14, 16),
-        (16, 20),
-        (20, 22),
-        (22, 24)
-    )
-
-    BLOCK = {
-        0: (3, 2, 1, 2, 1, 2, 3), # Visja sezona delovni dan
-        1: (4, 3, 2, 3, 2, 3, 4), # visja sezona dela prost dan
-        2: (4, 3, 2, 3, 2, 3, 4), # nizja sezona delovni dan
-        3: (5, 4, 3, 4, 3, 4, 5)  # nizja sezona dela prost dan
-    }
+        :param tariff: tariff calendar, see config/tariffs
+        """
+        self.tariff = tariff
+        self._valid_until = 0.0
+        # year -> (block id per hour of the year, index of the next change)
+        self._tables: dict[int, tuple[bytearray, array]] = {}
+
+        starts = tariff.zones
+        if not starts or starts[0] != 0 or starts[-1] > 23:
+            raise ValueError("Tariff zones must start at hour 0")
+        self._zones = [bisect_right(starts, hour) - 1 for hour in range(24)]
+
+        self._seasons = {}
+        for season, months in tariff.seasons.items():
+            for month in months:
+                self._seasons[month] = season
+        if sorted(self._seasons) != list(range(1, 13)):
+            raise ValueError("Tariff seasons must cover all 12 months")
+
+        for season in tariff.seasons:
+            rows = tariff.blocks.get(season, {})
+            for day_type in ("workday", "free"):
+                row = rows.get(day_type, ())
+                if len(row) != len(starts) or not all(
+                    0 < b < 256 for b in row):
+                    raise ValueError(
+                        f"Tariff blocks for {season} {day_type} must have "
+                        f"one block id (1 - 255) per zone")
+
+        self.max_block = max(max(row) for rows in tariff.blocks.values()
+                             for row in rows.values())
+
+        self._table(time.localtime().tm_year)
+
+
+    @staticmethod
+    def easter(year: int) -> date:
+        """
+        Easter Sunday of the Gregorian calendar (anonymous algorithm).
+        """
+        a, b, c = year % 19, year // 100, year % 100
+        d, e = divmod(b, 4)
+        g = (8*b + 13) // 25
+        h = (19*a + b - d - g + 15) % 30
+        i, k = divmod(c, 4)
+        l = (32 + 2*e + 2*i - h - k) % 7
+        m = (a + 11*h + 22*l) // 451
+        month, day = divmod(h + l - 7*m + 114, 31)
+        return date(year, month, day + 1)
+
+
+    def _holidays(self, year: int) -> set[date]:
+        days = set()
+        for holiday in self.tariff.holidays:
+            if len(holiday) == 5:
+                holiday = f"{year}-{holiday}"
+            day = date.fromisoformat(holiday)
+            if day.year == year:
+                days.add(day)
+
+        easter = self.easter(year)
+        days.update(easter + timedelta(offset)
+                    for offset in self.tariff.easter_holidays)
+
+        return days
+
+
+    def _table(self, year: int) -> tuple[bytearray, array]:
+        """
+        Build the block ids of every local hour of the year (8760 or 8784
+        bytes) and for every hour the index of the next hour with a
+        different block. Built once per year.
+        """
+        if year in self._tables:
+            return self._tables[year]
+
+        holidays = self._holidays(year)
+        rows = {}
+        for season in self.tariff.seasons:
+            for free, day_type in ((False, "workday"), (True, "free")):
+                row = self.tariff.blocks[season][day_type]
+                rows[season, free] = bytes(row[zone] for zone in self._zones)
+
+        jan1 = date(year, 1, 1)
+        n_days = (date(year + 1, 1, 1) - jan1).days
+        blocks = bytearray(24 * n_days)
+        for n in range(n_days):
+            day = jan1 + timedelta(n)
+            free = day in holidays or day.weekday() >= 5
+            blocks[24*n:24*(n + 1)] = rows[self._seasons[day.month], free]
+
+        # the last run ends with the year, the next year is a new table
+        changes = array("H", [len(blocks)]) * len(blocks)
+        for i in range(len(blocks) - 2, -1, -1):
+            changes[i] = i + 1 if blocks[i + 1] != blocks[i] else changes[i + 1]
+
+        # keep only the neighbouring years
+        for old in [y for y in self._tables if abs(y - year) > 1]:
+            del self._tables[old]
+        self._tables[year] = (blocks, changes)
+
+        return blocks, changes
+
+
+    def _lookup(self, ts: float) -> tuple[int, int]:
+        """
+        :return tuple: block id at ts and the unix time of the next change
+        """
+        lt = time.localtime(ts)
+        blocks, changes = self._table(lt.tm_year)
+        i = 24 * (lt.tm_yday - 1) + lt.tm_hour
+        nxt = changes[i]
+        # mktime normalizes day overflow into the next month or year
+        change_at = time.mktime(
+            (lt.tm_year, 1, 1 + nxt // 24, nxt % 24, 0, 0, 0, 0, -1))
 
-    MONTHS = {
-        1: ("H", (1, 2)), # novo leto
-        2: ("H", (8,)), # presernov dan
-        3: ("L", ()), 
-        4: ("L", (27,)), # dan upora
-        5: ("L", (1, 2)), # prvi maj
-        6: ("L", (25,)), # dan drzavnosti
-        7: ("L", ()),
-        8: ("L", (15,)), # Marijino vnebozetje
-        9: ("L", ()),
-        10: ("L", (31,)), # dan reformacije
-        11: ("H", (1,)), # dan spomina na mrtve
-        12: ("H", (25, 26)) # bozic, dan samostojnosti
-    }
+        return blocks[i], change_at
 
 
-    def __init__(self):
-        self._prev_hour = -1
-        self.ctime = time.time()
-        self.ltime = time.localtime(self.ctime)
+    def get_time_block(self, ts: float | None = None) -> int:
+        """
+        Tariff block (1 - 5) at ts, the current time by default.
+        """
+        block_id, change_at = self._lookup(time.time() if ts is None else ts)
+        if ts is None:
+            self._valid_until = change_at
 
+        return block_id
 
-    def get_time_block(self) -> int:
-        
-        season, holiday = self.MONTHS[self.ltime.tm_mon]
 
-        z_id = 0
-        for i, zone in enumerate(self.TIME_ZONE):
-            if zone[0] <= self.ltime.tm_hour and zone[1] > self.ltime.tm_hour:
-                z_id = i
-                break
-        
-        block_id = 0
-        if self.ltime.tm_mday in holiday or (
-            self.ltime.tm_wday == 5 or self.ltime.tm_wday == 6):
-            block_id = 1
+    def next_transition(self, ts: float | None = None) -> float:
+        """
+        Unix time when the block after ts changes.
+        """
+        return self._lookup(time.time() if ts is None else ts)[1]
 
-        if season == "L":
-            block_id += 2
 
-        self._prev_hour = self.ltime.tm_hour
+    def update_needed(self) -> bool:
+        """
+        True once the block returned by the last get_time_block call has
+        expired.
+        """
+        return time.time() >= self._valid_until
 
-        return self.BLOCK[block_id][z_id]
 
 
-    def update_needed(self) -> bool:
-        self.ctime = time.time()
-        self.ltime = time.localtime(self.ctime)
+class OutputDriver:
+    """
+    Output layer between the DecisionMaker and the GPIO pins. It tracks the
+    desired and applied state of every pin and only touches the hardware
+    when a state changes.
+    """
+    def __init__(self, pins: dict[str, DigitalOutputDevice]):
+        self.pins = pins
+        self.applied = dict.fromkeys(pins, False)
+        self.desired = dict.fromkeys(pins, False)
+        self._pending = False
 
-        if self._prev_hour == self.ltime.tm_hour:
-            return False
-        
-        return True
+        # stats
+        self.actuations = 0
+
+
+    def set(self, name: str, state: bool):
+        """
+        Set the desired pin state. Nothing is written until commit is called.
+        """
+        if name not in self.desired:
+            return
+
+        self.desired[name] = state
+        if state != self.applied[name]:
+            self._pending = True
+
+
+    def commit(self) -> int:
+        """
+        Apply all pending changes in one pass.
+
+        :return int: number of pins that were switched
+        """
+        if not self._pending:
+            return 0
+
+        changed = [(name, state) for name, state in self.desired.items()
+                   if state != self.applied[name]]
+        for name, state in changed:
+            if state:
+                self.pins[name].on()
+            else:
+                self.pins[name].off()
+            self.applied[name] = state
+
+        self.actuations += len(changed)
+        self._pending = False
+
+        return len(changed)
 
 
 
@@ -94,22 +238,22 @@ class DecisionMaker:
     current power levels.
     """
     def __init__(self, config: SysConfig,
-                 broadcaster: Callable[[TransferData], None] | None = None):
+                 broadcaster: Callable[[TransferData], None] | None = None,
+                 store: SampleStore | None = None):
         """
         Params
             config: dictionary from load_json function
             acq_time: time step that will be used within the loop
+            store: history store that receives the state transitions
         """
         self.config = config
-        self._pow_high = self.config.limit_1
-        self._pow_low = self.config.limit_1 - self.config.limit_diff
-        self._pow_list = (
-            self.config.limit_1, 
-            self.config.limit_2, 
-            self.config.limit_3, 
-            self.config.limit_4, 
-            self.config.limit_5
-        )
+        self.store = store
+        self.error_logger = logging.getLogger("error_logger")
+        self.tb: TimeBlock | None = None
+        self._tariff_mtime = None
+        self._load_tariff()
+        self._pow_high = self._pow_list[0]
+        self._pow_low = self._pow_high - self.config.limit_diff
         self.broadcaster = broadcaster
         self.current_time = time.monotonic()
         self.acq_time = config.cycle_time
@@ -118,7 +262,6 @@ class DecisionMaker:
         self._current_data = TransferData()
 
         self.data_logger = logging.getLogger("data_logger")
-        self.tb = TimeBlock()
 
         # trackers
         self.current_state = State.STANDBY
@@ -127,10 +270,94 @@ class DecisionMaker:
         self._lock = asyncio.Lock()
         self._is_updated = False
         self._event = asyncio.Event()
+        self._new_sample = asyncio.Event()
+        self._event_loop: asyncio.AbstractEventLoop | None = None
+
+        self.scheduler: Scheduler | None = None
+        self._timeout_job: Job | None = None
+        self._block_job: Job | None = None
+        self._heartbeat: Job | None = None
+
+        # metrics
+        self.state_time = dict.fromkeys((s.name for s in State), 0.0)
 
         self._initialize_pins()
 
 
+    def _limits(self, tb: TimeBlock) -> tuple[int, ...]:
+        """
+        Power limit per block, from the tariff or limit_1 .. limit_5.
+        """
+        limits = tuple(tb.tariff.limits) or (
+            self.config.limit_1, 
+            self.config.limit_2, 
+            self.config.limit_3, 
+            self.config.limit_4, 
+            self.config.limit_5
+        )
+        if tb.max_block > len(limits):
+            raise ValueError(f"Tariff uses block {tb.max_block} but "
+                             f"only {len(limits)} limits are set")
+
+        return limits
+
+
+    def _load_tariff(self, force: bool = False) -> bool:
+        """
+        Compile the tariff file if it changed since the last call. A broken
+        file keeps the current tariff, or a flat tariff with limit_1 if
+        there is none yet.
+
+        :return bool: True if a new tariff was applied
+        """
+        filename = CONFIG_DIR / self.config.tariff_file
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if not force and self.tb is not None and mtime == self._tariff_mtime:
+            return False
+        self._tariff_mtime = mtime
+
+        try:
+            tariff = load_tariff_config(filename)
+            tb = TimeBlock(tariff)
+            limits = self._limits(tb)
+
+        except Exception as err:
+            self.error_logger.error(f"Failed to load tariff {filename}\n{err}")
+            if self.tb is not None:
+                return False
+            tariff = TariffConfig()
+            tb = TimeBlock(tariff)
+            limits = self._limits(tb)
+
+        self.tb = tb
+        self._pow_list = limits
+        self.error_logger.info(f"Tariff loaded: {tariff.name}")
+
+        return True
+
+
+    def _update_limits(self):
+        """
+        Set the power limits of the current tariff block.
+        """
+        block_id = self.tb.get_time_block()
+        self._pow_high = self._pow_list[block_id-1]
+        self._pow_low = self._pow_high - self.config.limit_diff
+
+
+    def _reload_tariff(self):
+        """
+        Scheduler job that applies changes of the tariff file.
+        """
+        if self._load_tariff():
+            self._arm_block_change()
+            self._notify()
+
+
     def _initialize_pins(self):
         self.relay_pins: list[DigitalOutputDevice] = []
         self._initialized = False
@@ -157,6 +384,8 @@ class DecisionMaker:
         except Exception as err:
             print(f"Failed to initialize pins:\n{err}")
 
+        self.driver = OutputDriver(self._pins)
+
     
     def _clear_pins(self):
         for (key, pin) in self._pins.items():
@@ -177,12 +406,9 @@ class DecisionMaker:
             output depends on config.invert_logic value.
         :type state: bool
         """
-        if state:
-            for pin in self.relay_pins:
-                pin.on()
-        else:
-            for pin in self.relay_pins:
-                pin.off()
+        for name in self._pins:
+            if name != self.config.alarm_pin:
+                self.driver.set(name, state)
 
 
     def _set_alarm(self, state: bool):
@@ -193,17 +419,26 @@ class DecisionMaker:
             output depends on config.invert_logic value.
         :type state: bool
         """
-        if state:
-            self.alarm_pin.on()
-        else:
-            self.alarm_pin.off()
+        self.driver.set(self.config.alarm_pin, state)
+
 
+    # relay and alarm pin state per state
+    OUTPUTS = {
+        State.STANDBY: (False, False),
+        State.RELAY_ON: (True, False),
+        State.RELAY_TIMEOUT: (True, False),
+        State.ALARM_ON: (True, True),
+        State.ALARM_TIMEOUT: (True, False)
+    }
 
-    def _decision_loop(self):
+
+    def _decision_loop(self, dt: float):
         """
         The main logic of the class. It acts upon the received power value.
+
+        :param dt: time in seconds since the previous evaluation.
         """
-        self._timer += self.acq_time
+        self._timer += dt
        
         match self.current_state:
             case State.STANDBY:
@@ -211,8 +446,6 @@ class DecisionMaker:
                     self.current_state = State.RELAY_ON
                 
                 self._timer = 0
-                self._set_relays(False)
-                self._set_alarm(False)
 
             case State.RELAY_ON:
                 if self.current_power >= self._pow_high and (
@@ -224,9 +457,6 @@ class DecisionMaker:
                     self.current_state = State.RELAY_TIMEOUT
                     self._timer = 0
 
-                self._set_relays(True)
-                self._set_alarm(False)
-
             case State.RELAY_TIMEOUT:
                 if self.current_power >= self._pow_low:
                     self.current_state = State.RELAY_ON
@@ -236,9 +466,6 @@ class DecisionMaker:
                     self.current_state = State.STANDBY
                     self._timer = 0
 
-                self._set_relays(True)
-                self._set_alarm(False)
-
             case State.ALARM_ON:
                 if self.current_power < self._pow_high:
                     self.current_state = State.RELAY_ON
@@ -247,9 +474,6 @@ class DecisionMaker:
                 if self._timer >= self.config.alarm_on_time:
                     self.current_state = State.ALARM_TIMEOUT
                     self._timer = 0
-                
-                self._set_relays(True)
-                self._set_alarm(True)
 
             case State.ALARM_TIMEOUT:
                 if self.current_power < self._pow_high:
@@ -260,42 +484,211 @@ class DecisionMaker:
                     self.current_state = State.ALARM_ON
                     self._timer = 0
 
-                self._set_relays(True)
-                self._set_alarm(False)
-
             case _:
-                self._set_relays(False)
-                self._set_alarm(False)
                 self.current_state = State.STANDBY
                 self._timer = 0
+
+        # outputs follow the state the evaluation ended in, so a transition
+        # switches the pins in the same pass
+        relays, alarm = self.OUTPUTS[self.current_state]
+        self._set_relays(relays)
+        self._set_alarm(alarm)
     
 
     def update_value(self, data: TransferData):
-        # ideally this would have a lock, but it would require the
-        # mqtt subcriber to be asynchronous as well
+        """
+        Receive a new sample. Must be called from the event loop, the
+        MqqtSubscriber hands over its messages accordingly.
+        """
         self._current_data = data
         self.current_power = -data.grid
+        # the sender's clock may be off (no RTC, no NTP yet), so staleness
+        # uses the local receive time; the age is only exported as latency
         self.last_update = time.monotonic()
-        self.data_logger.info(f"Received {data}")
+        self.data_logger.info("Received %s", data)
         self._is_updated = True
+        self._notify()
+
+
+    def _notify(self):
+        """
+        Wake up the decision loop. Works from the event loop as well as from
+        other threads such as the paho network thread.
+        """
+        loop = self._event_loop
+        if loop is None:
+            return
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is loop:
+            self._new_sample.set()
+        else:
+            try:
+                loop.call_soon_threadsafe(self._new_sample.set)
+            except RuntimeError:
+                # event loop is already closed
+                pass
+
+
+    def _timeout_remaining(self) -> float | None:
+        """
+        Time until the current timeout state expires, None for states
+        without a timeout.
+        """
+        limit = {
+            State.RELAY_ON: self.config.alarm_delay,
+            State.RELAY_TIMEOUT: self.config.relay_timeout,
+            State.ALARM_ON: self.config.alarm_on_time,
+            State.ALARM_TIMEOUT: self.config.alarm_timeout
+        }.get(self.current_state)
+
+        if limit is None:
+            return None
+        # small margin so the timer is past the limit when we wake up
+        return max(0.01, limit - self._timer + 0.01)
+
+
+    def _next_wakeup(self) -> float:
+        """
+        Time until the decision has to be re-evaluated without new data,
+        either because a timeout state expires or as a periodic heartbeat
+        every cycle_time seconds. Only used without a scheduler.
+        """
+        remaining = self._timeout_remaining()
+        if remaining is None:
+            return self.acq_time
+        return min(self.acq_time, remaining)
+
+
+    def _arm_timeout(self):
+        """
+        Replace the scheduler timer for the current timeout state.
+        """
+        if self._timeout_job is not None:
+            self._timeout_job.cancel()
+            self._timeout_job = None
+
+        remaining = self._timeout_remaining()
+        if remaining is not None:
+            self._timeout_job = self.scheduler.call_later(
+                remaining, self._notify, "decision_timeout")
+
+
+    def _arm_block_change(self):
+        """
+        Wake the decision loop when the tariff block changes so the new
+        limits apply on the hour instead of the next heartbeat.
+        """
+        if self._block_job is not None:
+            self._block_job.cancel()
+
+        # small margin so update_needed sees the new block
+        delay = self.tb.next_transition() - time.time() + 0.01
+        self._block_job = self.scheduler.call_later(
+            delay, self._on_block_change, "time_block")
+
+
+    def _on_block_change(self):
+        self._notify()
+        self._arm_block_change()
+
+
+    def schedule(self, scheduler: Scheduler) -> Job:
+        """
+        Register the periodic heartbeat. Timeout states and tariff block
+        changes get their own one shot timers from the same scheduler.
+        """
+        self.scheduler = scheduler
+        self._arm_block_change()
+        scheduler.every(10, self._reload_tariff, "tariff_reload")
+        self._heartbeat = scheduler.every(self.acq_time, self._notify,
+                                          "decision")
+        return self._heartbeat
+
+
+    # changing these needs new GPIO devices
+    PIN_FIELDS = ("relay_pins", "alarm_pin", "invert_logic")
+
+
+    def reconfigure(self, config: SysConfig) -> bool:
+        """
+        Apply a new config in place. The state machine and the pins are kept,
+        new limits and timeouts are used from the next evaluation which is
+        triggered right away.
+
+        :return bool: False if the pins changed and a restart is needed
+        """
+        if any(getattr(config, name) != getattr(self.config, name)
+               for name in self.PIN_FIELDS):
+            return False
+
+        old, self.config = self.config, config
+        self.acq_time = config.cycle_time
+
+        if not self._load_tariff(force=config.tariff_file != old.tariff_file):
+            try:
+                self._pow_list = self._limits(self.tb)
+            except ValueError as err:
+                self.error_logger.error(f"Limits not applied\n{err}")
+        self._update_limits()
+
+        if self.scheduler is not None:
+            if config.cycle_time != old.cycle_time:
+                self.scheduler.reschedule(self._heartbeat, config.cycle_time)
+            self._arm_timeout()
+            self._arm_block_change()
+
+        self._notify()
+        return True
 
 
     async def loop(self):
         """
-        Async loop that should be used by the Task Manager.
+        Async loop that should be used by the Task Manager. The decision is
+        evaluated as soon as a new sample arrives and otherwise when a
+        timeout state expires or the tariff block changes.
         """
         self._event.set()
+        self._event_loop = asyncio.get_running_loop()
+        last_eval = time.monotonic()
 
         while self._event.is_set():
+            if self.scheduler is not None:
+                await self._new_sample.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self._new_sample.wait(),
+                                           self._next_wakeup())
+                except asyncio.TimeoutError:
+                    pass
+            self._new_sample.clear()
+
             t1 = time.monotonic()
 
             if self.tb.update_needed():
-                block_id = self.tb.get_time_block()
-                self._pow_high = self._pow_list[block_id-1]
-                self._pow_low = self._pow_high - self.config.limit_diff
+                self._update_limits()
 
             async with self._lock:
-                self._decision_loop()
+                prev_state = self.current_state
+                self.state_time[prev_state.name] += t1 - last_eval
+                self._decision_loop(t1 - last_eval)
+                switched = self.driver.commit()
+                last_eval = t1
+
+                if self._is_updated:
+                    observe_latency("decision", self._current_data.ts)
+                    if switched:
+                        observe_latency("gpio", self._current_data.ts)
+
+                if self.current_state != prev_state:
+                    if self.store:
+                        self.store.add_state(self.current_state)
+                    if self.scheduler is not None:
+                        self._arm_timeout()
 
                 self._is_updated = False
 
@@ -306,10 +699,28 @@ class DecisionMaker:
                     self._current_data.status = self.current_state.name
                     await self.broadcaster(self._current_data)
 
-                self.data_logger.info(f"State: {self.current_state}")
+                self.data_logger.info("State: %s", self.current_state)
+
 
-            t2 = time.monotonic()
-            await asyncio.sleep(max(0.1, self.acq_time - t2 + t1))
+    def collect(self, out: MetricsWriter):
+        out.add("counter", "solar_state_seconds_total",
+                "Time spent in each state",
+                [({"state": name}, t) for name, t in self.state_time.items()])
+        out.add("gauge", "solar_state",
+                "Current state",
+                [({"state": s.name}, s == self.current_state) for s in State])
+        out.add("counter", "solar_relay_actuations_total",
+                "Number of pin switches",
+                [(None, self.driver.actuations)])
+        out.add("gauge", "solar_relay_output",
+                "Applied state of each output pin",
+                [({"pin": name}, state)
+                 for name, state in self.driver.applied.items()])
+
+
+    @property
+    def ready(self) -> bool:
+        return self._initialized
 
 
     def stop(self):
@@ -318,42 +729,208 @@ class DecisionMaker:
 
 
 
-class SolarEdgeModbus:
+class ModbusConnection:
     """
-    Acquisition class to get data from inverter via Modbus.
+    Long-lived Modbus TCP connection shared across acquisition cycles. The
+    socket is only reopened after a failure, with exponential backoff so the
+    inverter's small socket budget is not exhausted.
     """
-    PV_POWER = 83
-    PV_SCALE = 84
-    GRID_POWER = 206
-    GRID_SCALE = 210
+    def __init__(self, config: ModbusConfig, ip: str, port: int):
+        self.config = config
+        self.host = f"{ip}:{port}"
+        # reconnect_delay=0 turns off the pymodbus auto reconnect, this
+        # class decides when to reconnect
+        self.client = AsyncModbusTcpClient(ip, port=port, 
+                                           timeout = config.timeout,
+                                           reconnect_delay = 0)
+        self.error_logger = logging.getLogger("error_logger")
 
+        self._backoff = 0.0
+        self._next_attempt = 0.0
 
-    def __init__(self, config: ModbusConfig, 
-                 publisher: Union["MqqtPublisher", DecisionMaker],
-                 broadcaster: Callable[[TransferData], None] = None):
+        # counters
+        self.connects = 0
+        self.reuses = 0
+        self.failures = 0
+        self.invalidations = 0
+
+
+    @property
+    def connected(self) -> bool:
+        return bool(self.client.connected)
+
+
+    @property
+    def backing_off(self) -> bool:
         """
-        config: dictionary from load_json function
+        True while a reconnect is being postponed after a failed attempt.
         """
-        self.client = AsyncModbusTcpClient(config.ip, port=config.port, 
-                                      timeout = config.timeout)
-        self.config = config
-        self.acq_time = config.acq_time
-        self.broadcaster = broadcaster
-        self.grid_power = 0
-        self.PV_power = 0
-        self.current_load = 0
+        return not self.connected and time.monotonic() < self._next_attempt
+
+
+    async def acquire(self) -> bool:
+        """
+        Make sure the client is connected. An open connection is reused,
+        otherwise a new one is established unless we are still waiting for
+        the backoff to expire.
+
+        :return bool: True if the client can be used for reading.
+        """
+        if self.connected:
+            self.reuses += 1
+            return True
+
+        if self.backing_off:
+            return False
+
+        try:
+            is_connected = await self.client.connect()
+        except Exception as err:
+            self.error_logger.exception(f"Failed to connect\n{err}")
+            is_connected = False
+
+        if is_connected:
+            self.connects += 1
+            self._backoff = 0.0
+            # give the inverter some time after a fresh handshake
+            await asyncio.sleep(self.config.connect_delay)
+            return True
+
+        self.failures += 1
+        self._backoff = min(max(2 * self._backoff, self.config.reconnect_min),
+                            self.config.reconnect_max)
+        self._next_attempt = time.monotonic() + self._backoff
+        self.client.close()
+        self.error_logger.warning("Modbus reconnect in %.1f s", self._backoff)
+
+        return False
+
+
+    def invalidate(self):
+        """
+        Drop the connection after a transport error. The next acquire call
+        will reconnect.
+        """
+        self.invalidations += 1
+        self.client.close()
+
+
+    def close(self):
+        self.client.close()
+
+
+
+class SampleWindow:
+    """
+    Rolling aggregate of fast samples for a single consumer. Every consumer
+    owns a window with its own period, so the decision logic, the publisher
+    and the websocket each receive data at their own rate.
+    """
+    FIELDS = ("grid", "PV", "load")
+
+
+    def __init__(self, period: float, stat: str = "mean"):
+        """
+        :param period: time in seconds between two flushes.
+        :param stat: value passed on when flushing. One of mean, min, max,
+            last or peak. Peak is the sample with the lowest grid value, i.e.
+            the highest power seen by the DecisionMaker.
+        """
+        self.period = period
+        self.stat = stat
+        self._deadline = time.monotonic() + period
+        self.reset()
+
+
+    def reset(self):
+        self.count = 0
+        self._sum = dict.fromkeys(self.FIELDS, 0)
+        self.min = {}
+        self.max = {}
+        self.last: TransferData | None = None
+        self.peak: TransferData | None = None
 
+
+    def add(self, data: TransferData):
+        self.count += 1
+        for key in self.FIELDS:
+            val = getattr(data, key)
+            self._sum[key] += val
+            self.min[key] = min(self.min.get(key, val), val)
+            self.max[key] = max(self.max.get(key, val), val)
+
+        self.last = data
+        if self.peak is None or data.grid < self.peak.grid:
+            self.peak = data
+
+
+    def mean(self) -> dict[str, float]:
+        return {key: self._sum[key] / max(1, self.count)
+                for key in self.FIELDS}
+
+
+    def is_due(self, now: float) -> bool:
+        return self.count > 0 and now >= self._deadline
+
+
+    def flush(self, now: float) -> TransferData:
+        """
+        Return the aggregated sample and start a new window.
+        """
+        match self.stat:
+            case "peak":
+                data = self.peak.model_copy()
+            case "last":
+                data = self.last.model_copy()
+            case "mean" | "min" | "max":
+                values = self.mean() if self.stat == "mean" else (
+                    getattr(self, self.stat))
+                data = self.last.model_copy(update={
+                    key: int(values[key]) for key in self.FIELDS})
+            case _:
+                raise ValueError(f"Unknown window stat {self.stat}!")
+
+        self._deadline = max(self._deadline + self.period, now)
+        self.reset()
+
+        return data
+
+
+
+class ModbusDevice:
+    """
+    A single modbus unit with an inverter and/or meter SunSpec model. The
+    connection is shared by all units on the same host and the host
+    semaphore bounds the number of requests in flight.
+    """
+    def __init__(self, config: ModbusConfig, source: ModbusSource,
+                 connection: ModbusConnection, host_lock: asyncio.Semaphore):
+        self.source = source
+        self.name = source.name or f"{connection.host}/{source.unit}"
+        self.connection = connection
+        self._host_lock = host_lock
         self.error_logger = logging.getLogger("error_logger")
-        self.data_logger = logging.getLogger("data_logger")
 
-        self.publisher = publisher
+        self._models = tuple(
+            (model, base) for model, base in (
+                (INVERTER, source.inverter_base),
+                (METER, source.meter_base))
+            if base is not None)
+        points = []
+        for model, base in self._models:
+            points.extend(model.points_at(base))
+        self._read_plan = plan_reads(points, config.max_gap, config.max_span)
+        self._image_size = max(
+            (b.address + b.count for b in self._read_plan), default=0)
+
+        self.inverter = None
+        self.meter = None
+
+        # metrics
+        self.read_time = Histogram()
+        self.timeouts = 0
 
-        self._event = asyncio.Event()
-        self._lock = asyncio.Lock()
-        self._error_counter = 0
-        self._prev_error = False
 
-        
     async def _read_register(self, address: int, count: int = 1) -> list[int]:
         """
         Tries to read registers in a safe way. If it fails an empty list is
@@ -362,225 +939,641 @@ class SolarEdgeModbus:
         :param address: modbus address to be read.
         """
         ret = None
+        t1 = time.monotonic()
         try:
-            ret = await self.client.read_holding_registers(address, count=count)
+            ret = await self.connection.client.read_holding_registers(
+                address, count=count, device_id=self.source.unit)
             
             if ret != None and not ret.isError():
                 return ret.registers
             
         except Exception as err:
-            self.error_logger.exception(f"Read register error\n{err}")
+            self.error_logger.exception("Read register error\n%s", err)
+            self.connection.invalidate()
+
+        finally:
+            self.read_time.observe(time.monotonic() - t1)
             
         return []
 
 
-    async def get_new_data(self) -> None:
+    async def read(self) -> bool | None:
         """
-        Run an infinite loop to acquire data via Modbus. Received power levels
-        are in watts.
+        Read and decode all models of the unit.
+
+        :return True: every model was decoded.
+        :return False: the connection or a model read failed.
+        :return None: skipped while the connection is backing off.
         """
+        self.inverter, self.meter = None, None
+
+        async with self._host_lock:
+            failures = self.connection.failures
+            if not await self.connection.acquire():
+                # only the unit that made the attempt reports the failure
+                return False if self.connection.failures > failures else None
+
+            image = [None] * self._image_size
+            for block in self._read_plan:
+                ret = await self._read_register(block.address, block.count)
+                if len(ret) == block.count:
+                    image[block.address:block.address + block.count] = ret
+                else:
+                    self.error_logger.warning(
+                        "%s: no data at %d. Received %d",
+                        self.name, block.address, len(ret))
+
+        ok = True
+        for model, base in self._models:
+            registers = image[base:base + model.size]
+            record = None
+            if None not in registers:
+                record = model.decode(registers)
+                if record is None:
+                    self.error_logger.warning(
+                        "%s: unexpected %s model at %d -> %d",
+                        self.name, model.name, base, registers[0])
+            ok = ok and record is not None
+            setattr(self, model.name, record)
+
+        return ok
+
+
+
+class SolarEdgeModbus:
+    """
+    Acquisition class to get data from the inverters and meters via Modbus.
+    All sources are read concurrently and merged into one sample per cycle.
+    """
+    def __init__(self, config: ModbusConfig, 
+                 publisher: Union["MqqtPublisher", DecisionMaker],
+                 broadcaster: Callable[[TransferData], None] = None,
+                 store: SampleStore | None = None):
+        """
+        config: dictionary from load_json function
+        store: history store that receives every sample
+        """
+        self.store = store
+        self.config = config
+        self.acq_time = config.acq_time
+        self.broadcaster = broadcaster
+        self.grid_power = 0
+        self.PV_power = 0
+        self.current_load = 0
+
+        self.error_logger = logging.getLogger("error_logger")
+        self.data_logger = logging.getLogger("data_logger")
+
+        self.publisher = publisher
 
+        self._lock = asyncio.Lock()
+        self._error_counter = 0
+        self._last_valid = time.monotonic()
+        self._prev_error = False
+        self._seq = 0
+
+        self.scheduler: Scheduler | None = None
+        self._poll_job: Job | None = None
+        self._build_devices()
+
+        # metrics
+        self.errors = 0
+
+
+    def _build_devices(self):
+        """
+        Create one connection and semaphore per host, shared by its units.
+        """
+        config = self.config
+        sources = config.sources or [ModbusSource(
+            ip=config.ip, port=config.port, inverter_base=config.inverter_base,
+            meter_base=config.meter_base)]
+        self.connections: dict[tuple[str, int], ModbusConnection] = {}
+        self.devices: list[ModbusDevice] = []
+        host_locks = {}
+        for source in sources:
+            key = (source.ip, source.port)
+            if key not in self.connections:
+                self.connections[key] = ModbusConnection(config, *key)
+                host_locks[key] = asyncio.Semaphore(
+                    max(1, config.host_concurrency))
+            self.devices.append(ModbusDevice(
+                config, source, self.connections[key], host_locks[key]))
+
+
+    async def _read_device(self, device: ModbusDevice) -> bool | None:
+        """
+        Read one device within source_timeout so a hanging device doesn't
+        stall the others.
+        """
         try:
-            is_connected = await self.client.connect()
-        except Exception as err:
-            self.error_logger.exception(f"Failed to connect\n{err}")
-            is_connected = False
+            return await asyncio.wait_for(device.read(),
+                                          self.config.source_timeout)
+        except asyncio.TimeoutError:
+            device.timeouts += 1
+            self.error_logger.warning("%s: read timed out", device.name)
+            # a late response would be taken for the next request
+            device.connection.invalidate()
+            return False
 
-        await asyncio.sleep(0.3)
 
-        if is_connected:
-            PV = await self._read_PV_power_value()
-            await asyncio.sleep(0.2)
-            GRID = await self._read_GRID_power_value()
-
-            if PV is not None and GRID is not None:
-                self.grid_power = GRID
-                self.PV_power = PV
-                # if we take from grid -> we get negative value
-                # if we return to grid -> we get positive value
-                self.current_load = PV - GRID
-                
-                # power levels are in watts
-                self.data_logger.info(
-                    f"{self.PV_power}\t{self.grid_power}\t{self.current_load}")
-                self._error_counter = 0
-                                
-            else:
-                self.grid_power = 0
-                self.PV_power = 0
-                self.current_load = 0
-                self.error_logger.warning("No logged values")
-                self._error_counter += 1
-         
+    async def get_new_data(self) -> bool:
+        """
+        Acquire data from all sources concurrently. Power levels are summed
+        over the inverters and over the meters and are in watts. The cycle
+        is only valid if every source was read.
+
+        :return bool: True if the cycle is valid, otherwise the power
+            levels are zeroed
+        """
+        results = await asyncio.gather(
+            *(self._read_device(device) for device in self.devices))
+
+        inverters = [d.inverter for d in self.devices if d.inverter]
+        meters = [d.meter for d in self.devices if d.meter]
+
+        PV, GRID = None, None
+        if all(results):
+            if inverters and all(i.W is not None for i in inverters):
+                PV = int(sum(i.W for i in inverters))
+            if meters and all(m.W is not None for m in meters):
+                GRID = int(sum(m.W for m in meters))
+
+        if PV is not None and GRID is not None:
+            self.grid_power = GRID
+            self.PV_power = PV
+            # if we take from grid -> we get negative value
+            # if we return to grid -> we get positive value
+            self.current_load = PV - GRID
+            
+            # power levels are in watts
+            self.data_logger.info("%d\t%d\t%d", self.PV_power,
+                                  self.grid_power, self.current_load)
+            self._error_counter = 0
+            self._last_valid = time.monotonic()
+                            
         else:
             self.grid_power = 0
             self.PV_power = 0
             self.current_load = 0
-            self.error_logger.warning("No modbus connection")
-
-            self._error_counter += 1
 
-        self.client.close()
+            # cycles skipped while waiting for the backoff are not errors
+            if False in results:
+                self.error_logger.warning("No modbus connection")
+                self._error_counter += 1
+                self.errors += 1
+            elif None not in results:
+                self.error_logger.warning("No logged values")
+                self._error_counter += 1
+                self.errors += 1
 
-        if self._error_counter > 10:
-            self.error_logger.info(f"Restarting system")
+        # time based, so fast sampling doesn't give up after a few seconds
+        if time.monotonic() - self._last_valid > self.config.restart_after:
+            self.error_logger.info(f"No valid sample for "
+                                   f"{self.config.restart_after} s, "
+                                   f"restarting system")
             sys.exit(1)
-     
-    
-    async def _read_PV_power_value(self) -> int | None:
+
+        return PV is not None and GRID is not None
+
+
+    def _transfer_data(self) -> TransferData:
+        """
+        Merge the latest values of all sources into a TransferData object.
+        Energies are summed, the AC values come from the first inverter and
+        the temperature is the hottest inverter.
         """
-        Read modbus values
+        self._seq += 1
+        data = TransferData(
+            grid=self.grid_power, PV=self.PV_power, load=self.current_load,
+            ts=time.time(), seq=self._seq)
+
+        inverters = [d.inverter for d in self.devices if d.inverter]
+        meters = [d.meter for d in self.devices if d.meter]
+
+        if inverters:
+            first = inverters[0]
+            data.voltage = first.PhVphA or 0
+            data.frequency = first.Hz or 0
+            data.inverter_status = first.St or 0
+            data.temperature = max(i.TmpSnk or 0 for i in inverters)
+            data.PV_energy = int(sum(i.WH or 0 for i in inverters))
+
+        if meters:
+            data.export_energy = int(sum(m.TotWhExp or 0 for m in meters))
+            data.import_energy = int(sum(m.TotWhImp or 0 for m in meters))
+
+        return data
 
-        :param args: tuple of register to read -> value, scale
 
-        :return int: if all is as expected 
-        :return None: if error when reading
+    def schedule(self, scheduler: Scheduler) -> Job:
         """
-        ret = await self._read_register(self.PV_POWER, 2)
-        val, pval = 0, 0
-        if len(ret) == 2:
-            val = self._uint2int(ret[0])
-            pval = self._uint2int(ret[1])
-        else:
-            self.error_logger.warning(f"No PV meter data. Received {len(ret)}")
-            return
-        
-        if pval < 5 and pval > -5:
-            return int(val * 10**pval)
+        Register the polling job. Polls start right away and then follow
+        acq_time (or fast_acq_time) aligned to the wall clock.
+        """
+        self.scheduler = scheduler
+        if not self.config.fast_sampling:
+            self._poll_job = scheduler.every(self.acq_time, self.poll,
+                                             "modbus", immediate=True)
+            return self._poll_job
+
+        self.windows = {
+            "publisher": SampleWindow(self.config.publish_time,
+                                      self.config.publish_stat),
+            "broadcaster": SampleWindow(self.config.broadcast_time)
+        }
+        self._poll_job = scheduler.every(self.config.fast_acq_time,
+                                         self.fast_poll, "modbus",
+                                         immediate=True)
+        return self._poll_job
+
+
+    # changing these needs new connections
+    DEVICE_FIELDS = ("ip", "port", "timeout", "sources", "inverter_base",
+                     "meter_base", "max_gap", "max_span", "host_concurrency")
+    # changing these needs a new polling job
+    POLL_FIELDS = ("acq_time", "fast_sampling", "fast_acq_time",
+                   "publish_time", "publish_stat", "broadcast_time")
+
+
+    async def reconfigure(self, config: ModbusConfig) -> bool:
+        """
+        Apply a new config in place. Devices are only rebuilt if their
+        addresses or read plan changed. A poll in progress is cancelled
+        instead of waited for, so this returns right away.
+
+        :return bool: always True, no setting needs a restart
+        """
+        old, self.config = self.config, config
+        self.acq_time = config.acq_time
+        devices = any(getattr(config, name) != getattr(old, name)
+                      for name in self.DEVICE_FIELDS)
+        polling = any(getattr(config, name) != getattr(old, name)
+                      for name in self.POLL_FIELDS)
+        if not (devices or polling):
+            for connection in self.connections.values():
+                connection.config = config
+            return True
+
+        # no new poll may start while the devices are replaced
+        interrupted = False
+        if self._poll_job is not None:
+            self.scheduler.remove(self._poll_job)
+            task = self._poll_job.task
+            if task is not None and not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+                interrupted = True
+
+        if devices:
+            for connection in self.connections.values():
+                connection.close()
+            self._build_devices()
         else:
-            self.error_logger.warning(f"pval is too big: {pval} at "\
-                                 f"{self.PV_POWER} -> {ret[0]}, {ret[1]}")
-            return
+            for connection in self.connections.values():
+                connection.config = config
+                # a cancelled request may still be answered
+                if interrupted and connection.connected:
+                    connection.invalidate()
 
+        if self.scheduler is not None:
+            self.schedule(self.scheduler)
 
-    async def _read_GRID_power_value(self) -> int | None:
-        """
-        Read modbus values
+        return True
 
-        :param args: tuple of register to read -> value, scale
 
-        :return int: if all is as expected 
-        :return None: if error when reading
+    async def poll(self) -> None:
         """
-        ret = await self._read_register(self.GRID_POWER, 5)
-        val, pval = 0, 0
-        if len(ret) == 5:
-            val = self._uint2int(ret[0])
-            pval = self._uint2int(ret[4])
-        else:
-            self.error_logger.warning(f"No GRID meter data. Received {len(ret)}")
-            return
+        Acquire one sample and pass it on.
+        """
+        valid = await self.get_new_data()
+
+        data = self._transfer_data()
+        # failed cycles still reach the decision maker as 0 W but are not
+        # history
+        if valid and self.store:
+            self.store.add_sample(data)
+        self.publisher.update_value(data)
         
-        if pval < 5 and pval > -5:
-            return int(val * 10**pval)
-        else:
-            self.error_logger.warning(f"pval is too big: {pval} at " \
-                                 f"{self.GRID_POWER} -> {ret[0]}, {ret[4]}")
-            return
+        if self.broadcaster:
+            await self.broadcaster(data.model_copy())
 
 
-    def _uint2int(self, val) -> int:
+    async def fast_poll(self) -> None:
         """
-        Cast unsigned int to signed int.
+        Acquire one sample and pass downsampled data to the publisher and
+        broadcaster at their own rates.
         """
-        if val >= 2**15:
-            return val - 2**16
-        
-        return val
+        valid = await self.get_new_data()
+
+        data = self._transfer_data()
+        # failed cycles still reach the decision maker as 0 W but are not
+        # history
+        if valid and self.store:
+            self.store.add_sample(data)
+        for window in self.windows.values():
+            window.add(data)
+
+        now = time.monotonic()
+        window = self.windows["publisher"]
+        if window.is_due(now):
+            self.publisher.update_value(window.flush(now))
+
+        window = self.windows["broadcaster"]
+        if window.is_due(now):
+            data = window.flush(now)
+            if self.broadcaster:
+                await self.broadcaster(data)
+
+
+    def collect(self, out: MetricsWriter):
+        out.add("histogram", "solar_modbus_read_seconds",
+                "Duration of a single modbus read request",
+                [({"device": d.name}, d.read_time) for d in self.devices])
+        out.add("counter", "solar_modbus_timeouts_total",
+                "Sources that exceeded source_timeout",
+                [({"device": d.name}, d.timeouts) for d in self.devices])
+        out.add("counter", "solar_modbus_read_errors_total",
+                "Acquisition cycles without valid data",
+                [(None, self.errors)])
+        out.add("gauge", "solar_modbus_error_streak",
+                "Consecutive failed acquisition cycles",
+                [(None, self._error_counter)])
+        connections = [({"host": c.host}, c)
+                       for c in self.connections.values()]
+        out.add("counter", "solar_modbus_connects_total",
+                "Modbus connection attempts that succeeded",
+                [(labels, c.connects) for labels, c in connections])
+        out.add("counter", "solar_modbus_reuses_total",
+                "Acquisitions that reused an open connection",
+                [(labels, c.reuses) for labels, c in connections])
+        out.add("counter", "solar_modbus_connect_failures_total",
+                "Modbus connection attempts that failed",
+                [(labels, c.failures) for labels, c in connections])
+        out.add("counter", "solar_modbus_invalidations_total",
+                "Connections dropped after a transport error",
+                [(labels, c.invalidations) for labels, c in connections])
+        out.add("gauge", "solar_modbus_backoff_seconds",
+                "Current reconnect backoff",
+                [(labels, c._backoff) for labels, c in connections])
+        out.add("gauge", "solar_modbus_connected",
+                "Modbus connection state",
+                [(labels, c.connected) for labels, c in connections])
+    
+    
+    @property
+    def ready(self) -> bool:
+        return all(c.connected for c in self.connections.values())
 
 
-    async def loop(self) -> None:
-        self._event.set()
+    def stop(self):
+        for connection in self.connections.values():
+            connection.close()
 
-        while self._event.is_set():
-            t1 = time.monotonic()
-            await self.get_new_data()
 
-            self.publisher.update_value(TransferData(
-                grid=self.grid_power, PV=self.PV_power, 
-                load=self.current_load))
-            
-            if self.broadcaster:
-                await self.broadcaster(TransferData(
-                    grid=self.grid_power, PV=self.PV_power, 
-                    load=self.current_load))
 
-            t2 = time.monotonic()
+# changing these needs a new broker connection
+BROKER_FIELDS = ("broker_ip", "port", "username", "password", "topic",
+                 "connect_timeout")
+
 
-            await asyncio.sleep(max(0.1, self.acq_time - t2 +t1))
-    
-    
-    def stop(self):
-        self._event.clear()
+
+def _connect_mqtt(client: mqtt.Client, config: MqttConfig):
+    """
+    Set up the broker connection without touching the network. The paho
+    network thread connects once loop_start is called and keeps retrying
+    while the broker is unreachable.
+    """
+    client.username_pw_set(username=config.username,
+                           password=config.password)
+    client.connect_timeout = config.connect_timeout
+    client.reconnect_delay_set(min_delay=10, max_delay=60)
+    client.connect_async(config.broker_ip, config.port, 300)
+
+
+
+def _stop_mqtt(client: mqtt.Client):
+    """
+    Disconnect and stop the network thread without blocking the caller.
+    loop_stop tells the thread to terminate, so it doesn't reconnect, and
+    joins it on a helper thread since that can take a second.
+    """
+    client.disconnect()
+    threading.Thread(target=client.loop_stop, name="mqtt-stop",
+                     daemon=True).start()
+
+
+
+def _reconnect_mqtt(client: mqtt.Client, config: MqttConfig):
+    """
+    Point a running client to a new broker. Blocks until the network thread
+    stopped, which can take up to connect_timeout, call it with
+    asyncio.to_thread.
+    """
+    client.disconnect()
+    client.loop_stop()
+    _connect_mqtt(client, config)
+    client.loop_start()
 
 
 
 class MqqtSubscriber:
+    """
+    Receives TransferData over MQTT. Messages are validated on the paho
+    network thread and handed over to the asyncio event loop through a
+    bounded queue, so the DecisionMaker is only ever touched from the loop.
+    """
     def __init__(self, 
                  config: MqttConfig, 
-                 decision_maker: DecisionMaker):
+                 decision_maker: DecisionMaker,
+                 store: SampleStore | None = None):
         self.config = config
+        self.store = store
         self.error_logger = logging.getLogger("error_logger")
         self.decision_maker = decision_maker
 
+        # single producer (paho thread), single consumer (event loop)
+        self._queue: deque[tuple[TransferData, bool]] = deque(
+            maxlen=config.queue_size)
+        self._scheduled = False
+        self._event_loop: asyncio.AbstractEventLoop | None = None
+
+        # counters
+        self.received = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.missed = 0 # live samples lost upstream, gaps in publisher seq
+        self._last_seq = 0
+
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
 
-        self.client.username_pw_set(username=self.config.username, 
-                                    password=self.config.password)
-        self.client.connect(self.config.broker_ip, self.config.port, 300)
-        self.client.reconnect_delay_set(min_delay=10, max_delay=60)
+        _connect_mqtt(self.client, self.config)
+
+
+    def _subscribe(self, client):
+        client.subscribe([(self.config.topic, self.config.live_qos),
+                          (self.config.topic + "/history",
+                           self.config.history_qos),
+                          (self.config.topic + "/backfill", 1)])
 
 
     def on_connect(self, client, userdata, flags, rc):
-        client.subscribe(self.config.topic)
+        self._subscribe(client)
         time.sleep(0.5)
         self.error_logger.info(f"Connected with result code {str(rc)}")
 
 
     def on_message(self, client, userdata, msg):
-        self.latest_msg = msg.payload.decode()
-        self.error_logger.info(f"Received: {self.latest_msg}")
+        self.latest_msg = msg.payload
+        # history and backfill topics carry batches of past samples
+        backfill = msg.topic != self.config.topic
         try:
-            val = json.loads(self.latest_msg)
-            data = TransferData(**val)
-            self.decision_maker.update_value(data)
-            
-        except:
-            self.error_logger.error("Unable to cast msg to int!")
+            if backfill:
+                batch = decode_batch(msg.payload, self.config.wire_format)
+            else:
+                batch = [decode_transfer_data(
+                    msg.payload, self.config.wire_format)]
+        except Exception:
+            self.invalid += 1
+            self.error_logger.error("Unable to decode msg %r", msg.payload)
+            return
+
+        for data in batch:
+            self.received += 1
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((data, backfill))
+
+        if not self._scheduled and self._event_loop is not None:
+            self._scheduled = True
+            try:
+                self._event_loop.call_soon_threadsafe(self._drain)
+            except RuntimeError:
+                # event loop is already closed
+                pass
+
+
+    def _drain(self):
+        """
+        Deliver the queued samples. Runs on the event loop. Batched samples
+        only go to the history, decisions are made on live data. Samples
+        received live and again in a history batch are dropped by the store.
+        """
+        self._scheduled = False
+        while self._queue:
+            data, backfill = self._queue.popleft()
+            if self.store:
+                self.store.add_sample(data)
+            if not backfill:
+                observe_latency("subscriber", data.ts)
+                if data.seq and self._last_seq and data.seq > self._last_seq + 1:
+                    self.missed += data.seq - self._last_seq - 1
+                self._last_seq = data.seq
+                self.decision_maker.update_value(data)
+
+
+    def collect(self, out: MetricsWriter):
+        out.add("counter", "solar_mqtt_received_total",
+                "MQTT messages received",
+                [(None, self.received)])
+        out.add("counter", "solar_mqtt_receive_errors_total",
+                "MQTT messages dropped or rejected by reason",
+                [({"reason": "dropped"}, self.dropped),
+                 ({"reason": "invalid"}, self.invalid)])
+        out.add("counter", "solar_mqtt_missed_total",
+                "Samples missing from the publisher sequence",
+                [(None, self.missed)])
+        out.add("gauge", "solar_mqtt_queued",
+                "MQTT messages waiting for the event loop",
+                [(None, len(self._queue))])
 
 
     def on_disconnect(self, client, userdate, rc):
         self.error_logger.info(f"Disconnected with result code {str(rc)}")
 
 
+    async def reconfigure(self, config: MqttConfig) -> bool:
+        """
+        Apply a new config in place. Only a new broker or topic reconnects
+        the client, a new QoS resubscribes.
+
+        :return bool: always True, no setting needs a restart
+        """
+        old, self.config = self.config, config
+        if config.queue_size != old.queue_size:
+            self._queue = deque(self._queue, maxlen=config.queue_size)
+
+        if any(getattr(config, name) != getattr(old, name)
+               for name in BROKER_FIELDS):
+            await asyncio.to_thread(_reconnect_mqtt, self.client, config)
+        elif ((config.live_qos, config.history_qos)
+              != (old.live_qos, old.history_qos)
+              and self.client.is_connected()):
+            # subscribing again replaces the QoS of the existing subscription
+            self._subscribe(self.client)
+
+        return True
+
+
     def start_loop(self):
+        """
+        Start the paho network thread. Must be called from the event loop
+        that runs the DecisionMaker.
+        """
+        self._event_loop = asyncio.get_running_loop()
         self.client.loop_start()
 
+
+    @property
+    def ready(self) -> bool:
+        return self.client.is_connected()
+
     
     def stop(self):
-        self.client.loop_stop()
-        self.client.disconnect()
+        # late messages of the stopping client don't reach the decision maker
+        self._event_loop = None
+        _stop_mqtt(self.client)
 
 
 
 
 
 class MqqtPublisher:
+    """
+    Publishes TransferData over MQTT. Every sample is sent on the live
+    control topic. Optionally all samples are also batched to the history
+    topic. While the broker is unreachable the samples are kept in a disk
+    backed ring buffer and replayed in batches on the backfill topic once
+    the connection is back.
+    """
     def __init__(self, config: MqttConfig):
         self.config = config
         self.error_logger = logging.getLogger("error_logger")
+        self.outbox = RingBuffer(DATA_DIR / "outbox.bin",
+                                 TRANSFER_STRUCT.size, config.outbox_size)
+        self._dirty = False
+        self._history: list[TransferData] = []
+        self.scheduler: Scheduler | None = None
+        self._history_job: Job | None = None
+
+        # samples are numbered when published, so the subscriber can tell
+        # lost samples from the ones dropped by the downsampling
+        self._seq = 0
+
+        # counters
+        self.sent = 0
+        self.history_sent = 0
+        self.buffered = 0
+        self.backfilled = 0
 
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
 
-        self.client.username_pw_set(username=self.config.username, 
-                                    password=self.config.password)
-        self.client.connect(self.config.broker_ip, self.config.port, 300)
-        self.client.reconnect_delay_set(min_delay=10, max_delay=60)
+        _connect_mqtt(self.client, self.config)
 
 
     def on_connect(self, client, userdata, flags, rc):
@@ -592,22 +1585,186 @@ class MqqtPublisher:
         self.error_logger.info(f"Disconnected with result code {str(rc)}")
 
 
+    @property
+    def _history_enabled(self) -> bool:
+        return self.config.history_interval > 0
+
+
     def update_value(self, data: TransferData):
-        msg = data.model_dump_json()
+        self._seq += 1
+        data = data.model_copy(update={"seq": self._seq})
+
+        if self._history_enabled:
+            self._history.append(data)
+            if len(self._history) >= self.config.history_batch:
+                self._publish_history()
+
+        if not self.client.is_connected():
+            # stale live data is useless, only keep it for the history
+            if not self._history_enabled:
+                self._buffer(data)
+            return
+
+        msg = encode_transfer_data(data, self.config.wire_format)
         ret = self.client.publish(
-            self.config.topic, payload=msg, qos=2, retain=False
+            self.config.topic, payload=msg, qos=self.config.live_qos,
+            retain=self.config.live_retain
         )
         if ret.rc == mqtt.MQTT_ERR_SUCCESS:
-            self.error_logger.info(f"Publisher sent: {msg}")
+            self.sent += 1
+            observe_latency("publisher", data.ts)
+            self.error_logger.debug("Publisher sent: %r", msg)
         else:
-            self.error_logger.warning(f"Publisher failed: {ret.rc}")
+            self.error_logger.warning("Publisher failed: %s", ret.rc)
+            if not self._history_enabled:
+                self._buffer(data)
+
+
+    def _publish_history(self):
+        """
+        Send the collected samples as one message on the history topic. If
+        that fails they go to the outbox and are backfilled later.
+        """
+        batch, self._history = self._history, []
+        if not batch:
+            return
+
+        ret = None
+        if self.client.is_connected():
+            ret = self.client.publish(
+                self.config.topic + "/history",
+                payload=encode_batch(batch, self.config.wire_format),
+                qos=self.config.history_qos, retain=False)
+
+        if ret is not None and ret.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.history_sent += len(batch)
+        else:
+            for data in batch:
+                self._buffer(data)
+
+
+    def _buffer(self, data: TransferData):
+        if not data.ts:
+            data = data.model_copy(update={"ts": time.time()})
+        self.outbox.append(pack_transfer_data(data))
+        self.buffered += 1
+        self._dirty = True
+
+
+    def _replay(self) -> bool:
+        """
+        Publish one batch of buffered samples on the backfill topic.
+
+        :return bool: True if more samples are waiting
+        """
+        count = min(self.config.backfill_batch, len(self.outbox))
+        batch = [unpack_transfer_data(record)
+                 for record in self.outbox.peek(count)]
+        if batch:
+            ret = self.client.publish(
+                self.config.topic + "/backfill",
+                payload=encode_batch(batch, self.config.wire_format),
+                qos=1, retain=False)
+            if ret.rc != mqtt.MQTT_ERR_SUCCESS:
+                return False
+            self.backfilled += len(batch)
+
+        self.outbox.consume(count)
+
+        return len(self.outbox) > 0
+
+
+    def schedule(self, scheduler: Scheduler):
+        """
+        Register the history batches, the backfill of buffered samples and
+        the periodic write of the ring buffer to the SD card.
+        """
+        self.scheduler = scheduler
+        if self._history_enabled:
+            self._history_job = scheduler.every(
+                self.config.history_interval, self._publish_history,
+                "mqtt_history")
+        scheduler.every(1, self._backfill, "mqtt_backfill")
+        scheduler.every(10, self._flush_outbox, "outbox_flush")
+
+
+    async def reconfigure(self, config: MqttConfig) -> bool:
+        """
+        Apply a new config in place. Only a new broker or topic reconnects
+        the client.
+
+        :return bool: False if the outbox size changed and a restart is
+            needed
+        """
+        if config.outbox_size != self.config.outbox_size:
+            return False
+
+        old, self.config = self.config, config
+        if config.history_interval != old.history_interval:
+            # send what was collected with the old settings
+            self._publish_history()
+            if self._history_job is not None:
+                self.scheduler.remove(self._history_job)
+                self._history_job = None
+            if self._history_enabled and self.scheduler is not None:
+                self._history_job = self.scheduler.every(
+                    config.history_interval, self._publish_history,
+                    "mqtt_history")
+
+        if any(getattr(config, name) != getattr(old, name)
+               for name in BROKER_FIELDS):
+            await asyncio.to_thread(_reconnect_mqtt, self.client, config)
+
+        return True
+
+
+    async def _backfill(self):
+        while len(self.outbox) and self.client.is_connected():
+            self._dirty = True
+            if not self._replay():
+                break
+            # keep some room for live data between two batches
+            await asyncio.sleep(0.1)
+
+
+    async def _flush_outbox(self):
+        if self._dirty:
+            self._dirty = False
+            await asyncio.to_thread(self.outbox.flush)
+
+
+    def collect(self, out: MetricsWriter):
+        out.add("counter", "solar_mqtt_published_total",
+                "Samples published by stream",
+                [({"stream": "live"}, self.sent),
+                 ({"stream": "history"}, self.history_sent),
+                 ({"stream": "backfill"}, self.backfilled)])
+        out.add("counter", "solar_mqtt_buffered_total",
+                "Samples written to the outbox",
+                [(None, self.buffered)])
+        out.add("gauge", "solar_mqtt_outbox",
+                "Samples waiting in the outbox",
+                [(None, len(self.outbox))])
+        out.add("counter", "solar_mqtt_outbox_dropped_total",
+                "Oldest samples overwritten in the full outbox",
+                [(None, self.outbox.dropped)])
+        out.add("gauge", "solar_mqtt_connected",
+                "Broker connection state",
+                [(None, self.client.is_connected())])
 
 
     def start_loop(self):
         self.client.loop_start()
 
+
+    @property
+    def ready(self) -> bool:
+        return self.client.is_connected()
+
     
     def stop(self):
-        self.client.loop_stop()
-        self.client.disconnect()
-
+        for data in self._history:
+            self._buffer(data)
+        self._history = []
+        _stop_mqtt(self.client)
+        self.outbox.close()
@@ -0,0 +1,111 @@
+import time
+from bisect import bisect_left
+
+
+
+class Histogram:
+    """
+    Histogram with fixed bucket bounds. All storage is allocated up front and
+    an observation is a bisect plus three additions.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10, 30, 60)
+
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def snapshot(self) -> dict:
+        cumulative, total = [], 0
+        for count in self.counts[:-1]:
+            total += count
+            cumulative.append(total)
+
+        return {
+            "buckets": dict(zip(self.buckets, cumulative)),
+            "count": self.count,
+            "sum": self.sum
+        }
+
+
+
+# time from acquisition (TransferData.ts) until a sample passed each hop
+HOPS = ("publisher", "subscriber", "decision", "gpio", "websocket")
+LATENCY = {hop: Histogram() for hop in HOPS}
+
+
+
+def observe_latency(hop: str, ts: float):
+    """
+    Record the age of a sample acquired at ts (unix time). Samples without
+    a timestamp are ignored. Across hosts this relies on synced clocks.
+    """
+    if ts:
+        LATENCY[hop].observe(max(0.0, time.time() - ts))
+
+
+
+class MetricsWriter:
+    """
+    Renders metrics in the Prometheus text exposition format. Values are
+    read at scrape time, so the hot paths only update plain counters.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+    def __init__(self):
+        self.lines: list[str] = []
+
+
+    @staticmethod
+    def _labels(labels: dict | None, **extra) -> str:
+        labels = {**(labels or {}), **extra}
+        if not labels:
+            return ""
+        items = []
+        for key, val in labels.items():
+            val = str(val).replace("\\", "\\\\").replace('"', '\\"')
+            items.append(f'{key}="{val}"')
+        return "{" + ",".join(items) + "}"
+
+
+    def add(self, kind: str, name: str, help: str, samples):
+        """
+        :param kind: counter, gauge or histogram.
+        :param samples: iterable of (labels, value) pairs. For histograms the
+            value is a Histogram instance.
+        """
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+        for labels, value in samples:
+            if kind != "histogram":
+                self.lines.append(
+                    f"{name}{self._labels(labels)} {float(value)}")
+                continue
+
+            total = 0
+            for bound, count in zip(value.buckets, value.counts):
+                total += count
+                self.lines.append(
+                    f"{name}_bucket{self._labels(labels, le=bound)} {total}")
+            self.lines.append(
+                f"{name}_bucket{self._labels(labels, le='+Inf')} "
+                f"{value.count}")
+            self.lines.append(f"{name}_sum{self._labels(labels)} {value.sum}")
+            self.lines.append(
+                f"{name}_count{self._labels(labels)} {value.count}")
+
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
@@ -6,10 +6,16 @@ from collections.abc import Callable
 from gpiozero import DigitalOutputDevice
 
 from lib.core import DecisionMaker, SolarEdgeModbus, MqqtPublisher, MqqtSubscriber
+from lib.storage import SampleStore
+from lib.scheduler import Scheduler
+from lib.metrics import observe_latency, Histogram, MetricsWriter, LATENCY
 from lib.utils import *
 
 import traceback
 import sys
+import time
+from collections import deque
+from typing import NamedTuple
 
 
 class BaseMode:
@@ -17,6 +23,8 @@ class BaseMode:
         self.brodcaster = broadcaster
         self.publisher: DecisionMaker | MqqtPublisher = None
         self.data_acq: SolarEdgeModbus | MqqtSubscriber = None
+        self.store: SampleStore | None = None
+        self.scheduler = Scheduler()
         log_dir = Path(__file__).resolve().parents[1] / "logs"
         log_dir.mkdir(exist_ok=True)
         setup_logging(log_dir)
@@ -30,10 +38,34 @@ class BaseMode:
 
 
     def stop_task(self):
+        self.scheduler.stop()
         if self.publisher:
             self.publisher.stop()
         if self.data_acq:
             self.data_acq.stop()
+        if self.store:
+            self.store.stop()
+
+
+    def readiness(self) -> dict[str, bool]:
+        """
+        Whether each component is connected or set up. Connections are made
+        in the background, so a mode starts before it is ready.
+        """
+        return {
+            type(component).__name__: component.ready
+            for component in (self.publisher, self.data_acq)
+            if component is not None
+        }
+
+
+    async def reconfigure(self, config: Config) -> bool:
+        """
+        Apply a new config to the running components in place.
+
+        :return bool: False if the mode has to be restarted instead
+        """
+        return False
 
 
     async def manage_msg(self, msg: str):
@@ -109,6 +141,10 @@ class Simulator(BaseMode):
         self._initialized = False
 
 
+    def readiness(self) -> dict[str, bool]:
+        return {"pins": self._initialized}
+
+
     async def manage_msg(self, msg):
         print("Managing msg")
         if not self._initialized:
@@ -127,12 +163,26 @@ class Simulator(BaseMode):
 class Standalone(BaseMode):
     def get_task(self):
         sys_config = load_sys_config()
-        self.publisher = DecisionMaker(sys_config, self.brodcaster)
+        self.store = SampleStore(DATA_DIR / "history.db", sys_config)
+        self.publisher = DecisionMaker(
+            sys_config, self.brodcaster, self.store)
 
         modbus_config = load_modbus_config()
-        self.data_acq = SolarEdgeModbus(modbus_config, self.publisher)
+        self.data_acq = SolarEdgeModbus(
+            modbus_config, self.publisher, store=self.store)
 
-        return [self.data_acq.loop(), self.publisher.loop()]
+        self.data_acq.schedule(self.scheduler)
+        self.publisher.schedule(self.scheduler)
+        self.store.schedule(self.scheduler)
+
+        return [self.scheduler.run(), self.publisher.loop()]
+
+
+    async def reconfigure(self, config: Config) -> bool:
+        # the decision maker refuses pin changes, check it first
+        return (self.publisher.reconfigure(config.sys)
+                and self.store.reconfigure(config.sys)
+                and await self.data_acq.reconfigure(config.modbus))
 
 
 
@@ -142,46 +192,195 @@ class Publisher(BaseMode):
         self.publisher = MqqtPublisher(mqtt_config)
         self.publisher.start_loop()
         
+        self.store = SampleStore(DATA_DIR / "history.db", load_sys_config())
         modbus_config = load_modbus_config()
         self.data_acq = SolarEdgeModbus(
-            modbus_config, self.publisher, self.brodcaster)
+            modbus_config, self.publisher, self.brodcaster, self.store)
+
+        self.data_acq.schedule(self.scheduler)
+        self.publisher.schedule(self.scheduler)
+        self.store.schedule(self.scheduler)
+
+        return [self.scheduler.run()]
+
 
-        return [self.data_acq.loop()]
+    async def reconfigure(self, config: Config) -> bool:
+        return (await self.publisher.reconfigure(config.mqtt)
+                and self.store.reconfigure(config.sys)
+                and await self.data_acq.reconfigure(config.modbus))
 
 
 
 class Subscriber(BaseMode):
     def get_task(self):
         sys_config = load_sys_config()
-        self.publisher = DecisionMaker(sys_config, self.brodcaster)
+        self.store = SampleStore(DATA_DIR / "history.db", sys_config)
+        self.publisher = DecisionMaker(
+            sys_config, self.brodcaster, self.store)
 
         mqtt_config = load_mqtt_config()
-        self.data_acq = MqqtSubscriber(mqtt_config, self.publisher)
+        self.data_acq = MqqtSubscriber(mqtt_config, self.publisher, self.store)
         self.data_acq.start_loop()
 
-        return [self.publisher.loop()]
+        self.publisher.schedule(self.scheduler)
+        self.store.schedule(self.scheduler)
+
+        return [self.scheduler.run(), self.publisher.loop()]
+
+
+    async def reconfigure(self, config: Config) -> bool:
+        return (self.publisher.reconfigure(config.sys)
+                and self.store.reconfigure(config.sys)
+                and await self.data_acq.reconfigure(config.mqtt))
     
 
 
+# websocket subprotocols
+# solar.json: full JSON frames, same as no subprotocol
+# solar.delta: JSON with only the fields that changed since the last frame
+# solar.bin: packed binary frames, see pack_transfer_data
+SUBPROTOCOLS = ("solar.json", "solar.delta", "solar.bin")
+
+
+
+class Frame(NamedTuple):
+    """
+    A broadcast message encoded once for every subprotocol in use.
+    """
+    seq: int
+    ts: float
+    full: str
+    delta: str | None
+    binary: bytes | None
+
+
+
+class ClientSender:
+    """
+    Sends broadcast frames to a single websocket from its own task. Frames
+    are kept in a small bounded queue and the oldest ones are dropped when
+    the client can't keep up, so a slow client never blocks the broadcaster.
+    """
+    def __init__(self, socket: WebSocket, on_close: Callable[[WebSocket], None],
+                 protocol: str | None = None, queue_size: int = 1):
+        self.socket = socket
+        self.protocol = protocol
+        self._last_seq = -1
+        self._on_close = on_close
+        self._queue: deque[tuple[float, Frame]] = deque(maxlen=queue_size)
+        self._event = asyncio.Event()
+
+        # stats
+        self.sent = 0
+        self.dropped = 0
+        self.lag = 0.0
+        self.send_time = Histogram()
+
+        self.task = asyncio.create_task(self._loop())
+
+
+    def push(self, frame: Frame):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append((time.monotonic(), frame))
+        self._event.set()
+
+
+    async def _loop(self):
+        try:
+            while True:
+                await self._event.wait()
+                self._event.clear()
+
+                while self._queue:
+                    t_push, frame = self._queue.popleft()
+                    t1 = time.monotonic()
+                    await self._send(frame)
+                    t2 = time.monotonic()
+                    self.send_time.observe(t2 - t1)
+                    self.lag = t2 - t_push
+                    observe_latency("websocket", frame.ts)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print("Broadcast crashed")
+            self._on_close(self.socket)
+
+
+    async def _send(self, frame: Frame):
+        """
+        Send the frame in the negotiated encoding. Deltas are only used when
+        the previous frame reached the client, otherwise the full frame is
+        sent.
+        """
+        match self.protocol:
+            case "solar.bin":
+                await self.socket.send_bytes(frame.binary)
+                self.sent += 1
+            case "solar.delta" if frame.seq == self._last_seq + 1:
+                if frame.delta != "{}":
+                    await self.socket.send_text(frame.delta)
+                    self.sent += 1
+            case _:
+                await self.socket.send_text(frame.full)
+                self.sent += 1
+
+        self._last_seq = frame.seq
+
+
+    def stop(self):
+        self.task.cancel()
+
+
+    def stats(self) -> dict:
+        return {
+            "client": str(self.socket.client),
+            "protocol": self.protocol,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "queued": len(self._queue),
+            "lag": self.lag
+        }
+
+
+
 class TaskManager:
     def __init__(self):
         self.model: BaseMode = None
+        self.mode: str | None = None
         self.task_list: list[asyncio.Task] = []
-        self.sockets: set[WebSocket] = set()
+        self.sockets: dict[WebSocket, ClientSender] = {}
+        self._seq = 0
+        self._last_msg: dict = {}
+        self.broadcast_time = Histogram()
 
 
-    def add_socket(self, socket: WebSocket):
-        self.sockets.add(socket)
+    @property
+    def store(self) -> SampleStore | None:
+        """
+        History store of the running mode, if it has one.
+        """
+        if self.model is None:
+            return None
+        return self.model.store
+
+
+    def add_socket(self, socket: WebSocket, protocol: str | None = None):
+        self.sockets[socket] = ClientSender(
+            socket, self.remove_socket, protocol)
 
 
     def remove_socket(self, socket: WebSocket):
-        self.sockets.discard(socket)
+        sender = self.sockets.pop(socket, None)
+        if sender is not None:
+            sender.stop()
+            print("Broadcast cleared ws")
 
 
     async def do_new_task(self, name: str):
-        if self.task_list:
+        if self.model is not None:
             await self.cancel_task()
-        await asyncio.sleep(1)
 
         match name:
             case "Standalone":
@@ -194,6 +393,7 @@ class TaskManager:
                 self.model = Simulator(self.broadcast)
             case _:
                 self.model = None
+        self.mode = name
         
         if self.model is not None:
             task_list = self.model.get_task()
@@ -206,6 +406,23 @@ class TaskManager:
         print("new task started")
 
 
+    async def apply_config(self, name: str, config: Config) -> bool:
+        """
+        Apply a saved config. The running mode is reconfigured in place when
+        it can be, otherwise it is restarted.
+
+        :return bool: True if the mode was restarted
+        """
+        if (self.model is not None and name == self.mode
+                and await self.model.reconfigure(config)):
+            print("config applied")
+            return False
+
+        await self.cancel_task()
+        await self.do_new_task(name)
+        return True
+
+
     def _crash_on_error(self, task: asyncio.Task):
         """Callback to force the whole program to exit on any task failure."""
         try:
@@ -220,32 +437,111 @@ class TaskManager:
 
 
     async def cancel_task(self):
-        if self.model is not None:
-            self.model.stop_task()
-
-        if self.task_list is not None:
-            for task in self.task_list:
-                task.cancel()
-                # return_exceptions = False to prevent silent task crashes!
-                await asyncio.gather(task, return_exceptions=False)
-
+        model, tasks = self.model, self.task_list
         self.model = None
         self.task_list = []
 
+        if model is not None:
+            model.stop_task()
+
+        for task in tasks:
+            task.cancel()
+        # crashes are reported by _crash_on_error, cancellation is expected
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+    def status(self) -> dict:
+        """
+        Running mode and readiness of its components.
+        """
+        components = {} if self.model is None else self.model.readiness()
+        return {
+            "mode": self.mode,
+            "running": bool(self.task_list),
+            "ready": bool(components) and all(components.values()),
+            "components": components
+        }
+
 
     async def broadcast(self, msg: TransferData):
-        dead = []
-        print("broadcasting in task manager")
-        for ws in self.sockets:
-            try:
-                await ws.send_json(msg.model_dump())
-            except:
-                dead.append(ws)
-                print("Broadcast crashed")
+        """
+        Encode the message once per subprotocol in use and queue it for
+        every client. Never waits on the clients themselves.
+        """
+        t1 = time.monotonic()
+        data = msg.model_dump()
+        protocols = {sender.protocol for sender in self.sockets.values()}
 
-        for ws in dead:
-            self.sockets.discard(ws)
-            print("Broadcast cleared ws")
+        delta = None
+        if "solar.delta" in protocols:
+            delta = json.dumps(
+                {k: v for k, v in data.items() if self._last_msg.get(k) != v},
+                separators=(",", ":"))
+
+        binary = None
+        if "solar.bin" in protocols:
+            binary = pack_transfer_data(msg)
+
+        self._seq += 1
+        self._last_msg = data
+        frame = Frame(self._seq, msg.ts,
+                      json.dumps(data, separators=(",", ":")), delta, binary)
+
+        for sender in self.sockets.values():
+            sender.push(frame)
+
+        self.broadcast_time.observe(time.monotonic() - t1)
+
+
+    def client_stats(self) -> list[dict]:
+        return [sender.stats() for sender in self.sockets.values()]
+
+
+    def metrics(self) -> str:
+        """
+        Render all metrics of the running mode in the Prometheus text format.
+        """
+        out = MetricsWriter()
+        out.add("histogram", "solar_sample_latency_seconds",
+                "Age of a sample when it passed each hop",
+                [({"hop": hop}, h) for hop, h in LATENCY.items()])
+        out.add("histogram", "solar_broadcast_seconds",
+                "Time to encode and queue a broadcast for all clients",
+                [(None, self.broadcast_time)])
+        senders = list(self.sockets.values())
+        out.add("histogram", "solar_ws_send_seconds",
+                "Duration of a websocket send per client",
+                [({"client": str(s.socket.client), "protocol": s.protocol or "solar.json"},
+                  s.send_time) for s in senders])
+        out.add("counter", "solar_ws_dropped_total",
+                "Frames dropped for slow clients",
+                [({"client": str(s.socket.client)}, s.dropped)
+                 for s in senders])
+
+        logs = LOGGING.stats()
+        out.add("counter", "solar_log_records_total",
+                "Log records by outcome",
+                [({"result": "handled"}, logs["handled"]),
+                 ({"result": "dropped"}, logs["dropped"])])
+        out.add("gauge", "solar_log_queued",
+                "Log records waiting for the listener thread",
+                [(None, logs["queued"])])
+
+        configs = CONFIGS.stats()
+        out.add("counter", "solar_config_reads_total",
+                "Config reads served from the cache or loaded from disk",
+                [({"result": "hit"}, configs["hits"]),
+                 ({"result": "load"}, configs["loads"])])
+
+        if self.model is not None:
+            self.model.scheduler.collect(out)
+            for component in (self.model.data_acq, self.model.publisher,
+                              self.model.store):
+                if hasattr(component, "collect"):
+                    component.collect(out)
+
+        return out.text()
 
 
     async def manage_msg(self, msg: str):
@@ -0,0 +1,305 @@
+import asyncio
+import heapq
+import inspect
+import time
+from collections.abc import Callable
+from functools import partial
+
+from lib.metrics import Histogram, MetricsWriter
+
+
+
+class Job:
+    """
+    A callback run by the Scheduler, either every period seconds or once.
+    """
+    def __init__(self, name: str, period: float, callback: Callable,
+                 align: bool):
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.align = align
+        self.deadline = 0.0
+        self.cancelled = False
+        self.task: asyncio.Task | None = None
+        # wall minus monotonic clock when the job was aligned
+        self._offset: float | None = None
+        self._started = 0.0
+
+        # stats
+        self.runs = 0
+        self.missed = 0
+        self.overruns = 0
+        self.lateness = Histogram()
+        self.duration = Histogram()
+
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+
+    def stats(self) -> dict:
+        return {
+            "period": self.period,
+            "runs": self.runs,
+            "missed": self.missed,
+            "overruns": self.overruns
+        }
+
+
+
+class Scheduler:
+    """
+    Runs periodic jobs from a single event loop timer. Deadlines are absolute
+    monotonic times, so a slow iteration doesn't shift the following ones.
+    Aligned jobs tick on wall clock multiples of their period (a 30 s job
+    runs at :00 and :30).
+
+    Ticks the loop woke up too late for are skipped and counted as missed.
+    Coroutine jobs run as their own task. A tick that finds the previous run
+    still busy is skipped and counted as an overrun instead of queueing up.
+    """
+    # realign when the wall clock jumps by more than this (NTP sync on a
+    # board without RTC)
+    CLOCK_STEP = 1.0
+
+
+    def __init__(self):
+        self.jobs: list[Job] = []
+        self._heap: list[tuple[float, int, Job]] = []
+        self._count = 0
+        self._handle: asyncio.TimerHandle | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._done: asyncio.Future | None = None
+
+
+    def every(self, period: float, callback: Callable, name: str,
+              align: bool = True, immediate: bool = False) -> Job:
+        """
+        Run callback every period seconds.
+
+        :param callback: function or coroutine function without arguments.
+        :param name: job name used in stats and metrics.
+        :param align: tick on wall clock multiples of period.
+        :param immediate: also run once right away instead of waiting for
+            the first tick.
+        """
+        job = Job(name, period, callback, align)
+        self.jobs.append(job)
+
+        now = time.monotonic()
+        if immediate:
+            job.deadline = now
+        elif align:
+            job.deadline = now + self._to_boundary(job)
+        else:
+            job.deadline = now + period
+
+        self._push(job)
+        return job
+
+
+    def call_later(self, delay: float, callback: Callable,
+                   name: str = "once") -> Job:
+        """
+        Run callback once after delay seconds.
+        """
+        job = Job(name, 0, callback, False)
+        job.deadline = time.monotonic() + max(0.0, delay)
+        self._push(job)
+        return job
+
+
+    def reschedule(self, job: Job, period: float):
+        """
+        Change the period of a periodic job. The next tick follows the new
+        period, a run in progress is not interrupted.
+        """
+        job.period = period
+        now = time.monotonic()
+        if job.align:
+            deadline = now + self._to_boundary(job)
+        else:
+            deadline = now + period
+
+        if deadline != job.deadline:
+            # the old heap entry is skipped because its deadline doesn't match
+            job.deadline = deadline
+            self._push(job)
+
+
+    def remove(self, job: Job):
+        """
+        Stop scheduling a job and drop it from the stats. A run in progress
+        is not interrupted.
+        """
+        job.cancelled = True
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+
+    async def run(self):
+        """
+        Async loop that should be used by the Task Manager. Returns after
+        stop and raises if a job failed.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._done = self._loop.create_future()
+        self._arm()
+        await self._done
+
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        for _, _, job in self._heap:
+            job.cancel()
+        for job in self.jobs:
+            job.cancel()
+        self._heap = []
+
+        if self._done is not None and not self._done.done():
+            self._done.set_result(None)
+
+
+    def _to_boundary(self, job: Job) -> float:
+        """
+        Time until the next wall clock multiple of the job period.
+        """
+        wall = time.time()
+        job._offset = wall - time.monotonic()
+        delay = -wall % job.period
+        # never hand out a tick that is due right away
+        return delay if delay > 0.001 else delay + job.period
+
+
+    def _push(self, job: Job):
+        self._count += 1
+        heapq.heappush(self._heap, (job.deadline, self._count, job))
+        if self._heap[0][2] is job:
+            self._arm()
+
+
+    @staticmethod
+    def _stale(deadline: float, count: int, job: Job) -> bool:
+        return job.cancelled or deadline != job.deadline
+
+
+    def _arm(self):
+        """
+        Set the event loop timer to the earliest deadline.
+        """
+        if self._loop is None:
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        while self._heap and self._stale(*self._heap[0]):
+            heapq.heappop(self._heap)
+
+        if self._heap:
+            # the default event loop clock is time.monotonic
+            self._handle = self._loop.call_at(self._heap[0][0], self._tick)
+
+
+    def _tick(self):
+        self._handle = None
+        now = time.monotonic()
+
+        # the event loop may fire the timer up to its clock resolution early
+        while self._heap and self._heap[0][0] <= now + 0.001:
+            deadline, count, job = heapq.heappop(self._heap)
+            if self._stale(deadline, count, job):
+                continue
+
+            try:
+                self._fire(job, now)
+            except Exception as err:
+                self._fail(err)
+
+            if job.period:
+                self._advance(job, now)
+                self._count += 1
+                heapq.heappush(self._heap, (job.deadline, self._count, job))
+
+        self._arm()
+
+
+    def _fire(self, job: Job, now: float):
+        job.lateness.observe(max(0.0, now - job.deadline))
+
+        if job.task is not None and not job.task.done():
+            job.overruns += 1
+            return
+
+        job.runs += 1
+        job._started = now
+        result = job.callback()
+
+        if inspect.isawaitable(result):
+            job.task = asyncio.ensure_future(result)
+            job.task.add_done_callback(partial(self._job_done, job))
+        else:
+            job.duration.observe(time.monotonic() - now)
+
+
+    def _job_done(self, job: Job, task: asyncio.Task):
+        job.duration.observe(time.monotonic() - job._started)
+        if task.cancelled():
+            return
+
+        err = task.exception()
+        if err is not None:
+            self._fail(err)
+
+
+    def _fail(self, err: BaseException):
+        """
+        Hand a job error to run so the Task Manager sees the crash.
+        """
+        if self._done is not None and not self._done.done():
+            self._done.set_exception(err)
+
+
+    def _advance(self, job: Job, now: float):
+        """
+        Move the deadline to the next tick in the future.
+        """
+        if job.align and (job._offset is None or abs(
+            time.time() - time.monotonic() - job._offset) > self.CLOCK_STEP):
+            job.deadline = now + self._to_boundary(job)
+            return
+
+        job.deadline += job.period
+        if job.deadline <= now:
+            skipped = int((now - job.deadline) // job.period) + 1
+            job.missed += skipped
+            job.deadline += skipped * job.period
+
+
+    def stats(self) -> dict:
+        return {job.name: job.stats() for job in self.jobs}
+
+
+    def collect(self, out: MetricsWriter):
+        jobs = [({"job": job.name}, job) for job in self.jobs]
+        out.add("histogram", "solar_job_lateness_seconds",
+                "Delay of a job tick past its deadline",
+                [(labels, job.lateness) for labels, job in jobs])
+        out.add("histogram", "solar_job_duration_seconds",
+                "Run time of a job",
+                [(labels, job.duration) for labels, job in jobs])
+        out.add("counter", "solar_job_runs_total",
+                "Ticks that ran the job",
+                [(labels, job.runs) for labels, job in jobs])
+        out.add("counter", "solar_job_missed_total",
+                "Ticks skipped because the event loop woke up too late",
+                [(labels, job.missed) for labels, job in jobs])
+        out.add("counter", "solar_job_overruns_total",
+                "Ticks skipped because the previous run was still busy",
+                [(labels, job.overruns) for labels, job in jobs])
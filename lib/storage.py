@@ -0,0 +1,569 @@
+import sqlite3
+import threading
+import mmap
+import struct
+import zlib
+import asyncio
+import logging
+import time
+from pathlib import Path
+from functools import partial
+from collections import deque
+
+from lib.utils import *
+from lib.scheduler import Scheduler
+from lib.metrics import MetricsWriter
+
+
+
+RESOLUTIONS = ("minute", "hour", "day")
+FIELDS = ("grid", "PV", "load")
+STATES = tuple(state.name for state in State)
+
+ROLLUP_COLUMNS = (
+    "res", "start", "n",
+    *(f"{key}_{stat}" for key in FIELDS for stat in ("mean", "min", "max")),
+    "import_wh", "export_wh", "self_wh",
+    *(f"t_{name}" for name in STATES)
+)
+
+
+
+def bucket_bounds(res: str, ts: float) -> tuple[float, float]:
+    """
+    Return the start and end of the rollup bucket containing ts. Days start
+    at local midnight.
+    """
+    match res:
+        case "minute":
+            start = ts - ts % 60
+            return start, start + 60
+        case "hour":
+            start = ts - ts % 3600
+            return start, start + 3600
+        case "day":
+            lt = time.localtime(ts)
+            start = time.mktime(
+                (lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1))
+            end = time.mktime(
+                (lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+            return start, end
+        case _:
+            raise ValueError(f"Unknown resolution {res}!")
+
+
+
+class Bucket:
+    """
+    Aggregates of all samples within one minute, hour or day.
+    """
+    def __init__(self, res: str, ts: float):
+        self.res = res
+        self.start, self.end = bucket_bounds(res, ts)
+        self.n = 0
+        self.sum = dict.fromkeys(FIELDS, 0)
+        self.min = dict.fromkeys(FIELDS, None)
+        self.max = dict.fromkeys(FIELDS, None)
+        self.import_wh = 0.0
+        self.export_wh = 0.0
+        self.self_wh = 0.0
+        self.state_time = dict.fromkeys(STATES, 0.0)
+
+
+    def add(self, values: tuple[int, int, int]):
+        self.n += 1
+        for key, val in zip(FIELDS, values):
+            self.sum[key] += val
+            if self.min[key] is None or val < self.min[key]:
+                self.min[key] = val
+            if self.max[key] is None or val > self.max[key]:
+                self.max[key] = val
+
+
+    def row(self) -> tuple:
+        stats = []
+        for key in FIELDS:
+            stats.extend((self.sum[key] / max(1, self.n),
+                          self.min[key], self.max[key]))
+
+        return (self.res, self.start, self.n, *stats,
+                self.import_wh, self.export_wh, self.self_wh,
+                *self.state_time.values())
+
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "Bucket":
+        values = dict(zip(ROLLUP_COLUMNS, row))
+        bucket = cls(values["res"], values["start"])
+        bucket.n = values["n"]
+        for key in FIELDS:
+            bucket.sum[key] = values[f"{key}_mean"] * bucket.n
+            bucket.min[key] = values[f"{key}_min"]
+            bucket.max[key] = values[f"{key}_max"]
+        bucket.import_wh = values["import_wh"]
+        bucket.export_wh = values["export_wh"]
+        bucket.self_wh = values["self_wh"]
+        for name in STATES:
+            bucket.state_time[name] = values[f"t_{name}"]
+
+        return bucket
+
+
+
+class RollupEngine:
+    """
+    Incrementally maintained minute, hour and day aggregates. Energy is
+    integrated between consecutive samples using the power of the earlier
+    sample. Gaps longer than max_gap seconds are not integrated.
+    """
+    def __init__(self, max_gap: float):
+        self.max_gap = max_gap
+        self.buckets: dict[str, Bucket | None] = dict.fromkeys(RESOLUTIONS)
+        self.closed: list[tuple] = []
+        self._prev: tuple | None = None
+        self._state: str | None = None
+
+
+    def resume(self, bucket: Bucket):
+        """
+        Continue a bucket that was stored before a restart.
+        """
+        self.buckets[bucket.res] = bucket
+
+
+    def set_state(self, state: str):
+        self._state = state
+
+
+    def add_sample(self, ts: float, grid: int, PV: int, load: int):
+        if self._prev is not None and ts < self._prev[0]:
+            # late samples (e.g. MQTT backfill) would reopen closed buckets
+            return
+
+        dt, imp, exp, own = 0.0, 0.0, 0.0, 0.0
+        if self._prev is not None and 0 < ts - self._prev[0] <= self.max_gap:
+            dt = ts - self._prev[0]
+            p_grid, p_PV = self._prev[1], self._prev[2]
+            # positive grid values are returned to the grid
+            exp = max(0, p_grid) * dt / 3600
+            imp = max(0, -p_grid) * dt / 3600
+            own = max(0, p_PV - max(0, p_grid)) * dt / 3600
+
+        for res in RESOLUTIONS:
+            bucket = self.buckets[res]
+            if bucket is None or not bucket.start <= ts < bucket.end:
+                if bucket is not None:
+                    self.closed.append(bucket.row())
+                bucket = Bucket(res, ts)
+                self.buckets[res] = bucket
+
+            bucket.add((grid, PV, load))
+            bucket.import_wh += imp
+            bucket.export_wh += exp
+            bucket.self_wh += own
+            if self._state is not None:
+                bucket.state_time[self._state] += dt
+
+        self._prev = (ts, grid, PV, load)
+
+
+    def pop_rows(self) -> list[tuple]:
+        """
+        Return the closed buckets and the current state of the open ones.
+        """
+        rows, self.closed = self.closed, []
+        rows.extend(b.row() for b in self.buckets.values() if b is not None)
+
+        return rows
+
+
+
+class RingBuffer:
+    """
+    Bounded FIFO of fixed size records in a memory mapped file. When full,
+    the oldest records are overwritten. Every record carries a CRC, so a
+    record torn by a power loss is skipped instead of replayed.
+    """
+    HEADER = struct.Struct("<QQ") # write and read counters
+    CRC = struct.Struct("<I")
+
+
+    def __init__(self, filename: Path, record_size: int, capacity: int):
+        self.record_size = record_size
+        self.capacity = capacity
+        self._slot = self.CRC.size + record_size
+        size = self.HEADER.size + capacity * self._slot
+
+        Path(filename).parent.mkdir(exist_ok=True)
+        self._file = open(filename, "a+b")
+        resized = self._file.seek(0, 2) != size
+        if resized:
+            self._file.truncate(size)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+
+        self.dropped = 0
+        self.corrupt = 0
+        if resized:
+            self._write, self._read = 0, 0
+            self._store_header()
+        else:
+            self._write, self._read = self.HEADER.unpack_from(self._mm, 0)
+            if self._read > self._write or (
+                self._write - self._read > capacity):
+                self._write, self._read = 0, 0
+
+
+    def __len__(self) -> int:
+        return self._write - self._read
+
+
+    def _store_header(self):
+        self.HEADER.pack_into(self._mm, 0, self._write, self._read)
+
+
+    def _offset(self, index: int) -> int:
+        return self.HEADER.size + (index % self.capacity) * self._slot
+
+
+    def append(self, record: bytes):
+        if len(record) != self.record_size:
+            raise ValueError(f"Expected {self.record_size} bytes, "
+                             f"received {len(record)}")
+
+        offset = self._offset(self._write)
+        self.CRC.pack_into(self._mm, offset, zlib.crc32(record))
+        self._mm[offset + self.CRC.size:offset + self._slot] = record
+        self._write += 1
+
+        if len(self) > self.capacity:
+            self._read = self._write - self.capacity
+            self.dropped += 1
+        self._store_header()
+
+
+    def peek(self, count: int) -> list[bytes]:
+        """
+        Return up to count of the oldest records without removing them.
+        Corrupt records are left out.
+        """
+        records = []
+        for index in range(self._read, min(self._read + count, self._write)):
+            offset = self._offset(index)
+            (crc,) = self.CRC.unpack_from(self._mm, offset)
+            record = self._mm[offset + self.CRC.size:offset + self._slot]
+            if zlib.crc32(record) == crc:
+                records.append(record)
+            else:
+                self.corrupt += 1
+
+        return records
+
+
+    def consume(self, count: int):
+        self._read = min(self._read + count, self._write)
+        self._store_header()
+
+
+    def flush(self):
+        """
+        Write the dirty pages to the storage. Blocking.
+        """
+        self._mm.flush()
+
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()
+
+
+
+class SampleStore:
+    """
+    Append-only history of power samples and DecisionMaker state
+    transitions stored in SQLite.
+
+    Appends only go into a small in-memory buffer. The buffer is written in a
+    single transaction every history_flush seconds from a worker thread, which
+    keeps the number of flash writes low. The database runs in WAL mode, so
+    a power loss can at most lose the last unflushed batch.
+
+    Minute, hour and day rollups are maintained as samples arrive and
+    written together with the samples.
+
+    A sample that arrives twice (live and in a history batch over MQTT) is
+    only stored once, recognised by its ts and seq.
+    """
+    # (ts, seq) keys remembered for the duplicate check
+    RECENT = 10000
+
+
+    def __init__(self, filename: Path, config: SysConfig):
+        """
+        :param filename: path to the database file.
+        :param config: history_flush and history_retention are used.
+        """
+        self.filename = filename
+        self.config = config
+        self.error_logger = logging.getLogger("error_logger")
+
+        self._samples: list[tuple] = []
+        self._states: list[tuple] = []
+        self._recent: set[tuple[float, int]] = set()
+        self._recent_order: deque[tuple[float, int]] = deque()
+        self.duplicates = 0
+        self._buffer_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self.rollups = RollupEngine(config.connection_timeout)
+        self.scheduler: Scheduler | None = None
+
+        Path(filename).parent.mkdir(exist_ok=True)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "ts REAL NOT NULL, grid INTEGER, PV INTEGER, load INTEGER)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS states (ts REAL NOT NULL, state TEXT)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS states_ts ON states (ts)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rollups ("
+            + ", ".join(ROLLUP_COLUMNS) + ", PRIMARY KEY (res, start)) "
+            "WITHOUT ROWID")
+        self._db.commit()
+
+        for res in RESOLUTIONS:
+            row = self._db.execute(
+                "SELECT * FROM rollups WHERE res = ? "
+                "ORDER BY start DESC LIMIT 1", (res,)).fetchone()
+            if row is not None:
+                self.rollups.resume(Bucket.from_row(row))
+
+        row = self._db.execute(
+            "SELECT state FROM states ORDER BY ts DESC LIMIT 1").fetchone()
+        if row is not None:
+            self.rollups.set_state(row[0])
+
+
+    def add_sample(self, data: TransferData, ts: float | None = None):
+        """
+        Queue a sample. Safe to call from any thread.
+        """
+        if ts is None:
+            ts = data.ts or time.time()
+        key = (ts, data.seq)
+        with self._buffer_lock:
+            if key in self._recent:
+                self.duplicates += 1
+                return
+            self._recent.add(key)
+            self._recent_order.append(key)
+            if len(self._recent_order) > self.RECENT:
+                self._recent.discard(self._recent_order.popleft())
+
+            self._samples.append((ts, data.grid, data.PV, data.load))
+            self.rollups.add_sample(ts, data.grid, data.PV, data.load)
+
+
+    def add_state(self, state: State, ts: float | None = None):
+        """
+        Queue a DecisionMaker state transition. Safe to call from any thread.
+        """
+        ts = time.time() if ts is None else ts
+        with self._buffer_lock:
+            self._states.append((ts, state.name))
+            self.rollups.set_state(state.name)
+
+
+    def flush(self):
+        """
+        Write the buffered records in one transaction. Blocking, use
+        asyncio.to_thread when calling from the event loop.
+        """
+        with self._buffer_lock:
+            samples, self._samples = self._samples, []
+            states, self._states = self._states, []
+            rollups = self.rollups.pop_rows() if samples else []
+
+        if not samples and not states:
+            return
+
+        with self._db_lock:
+            try:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT INTO samples VALUES (?, ?, ?, ?)", samples)
+                    self._db.executemany(
+                        "INSERT INTO states VALUES (?, ?)", states)
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO rollups VALUES ("
+                        + ", ".join("?" * len(ROLLUP_COLUMNS)) + ")",
+                        rollups)
+            except sqlite3.Error as err:
+                self.error_logger.error(f"Failed to store history\n{err}")
+
+
+    def prune(self):
+        """
+        Delete records older than history_retention days and give the freed
+        pages back to the file system. Hour and day rollups are kept.
+        """
+        limit = time.time() - self.config.history_retention * 86400
+        with self._db_lock:
+            try:
+                with self._db:
+                    self._db.execute("DELETE FROM samples WHERE ts < ?",
+                                     (limit,))
+                    self._db.execute("DELETE FROM states WHERE ts < ?",
+                                     (limit,))
+                    self._db.execute(
+                        "DELETE FROM rollups WHERE res = 'minute' AND "
+                        "start < ?", (limit,))
+                self._db.execute("PRAGMA incremental_vacuum")
+            except sqlite3.Error as err:
+                self.error_logger.error(f"Failed to prune history\n{err}")
+
+
+    def get_samples(self, start: float, end: float) -> list[tuple]:
+        """
+        Return (ts, grid, PV, load) rows with start <= ts < end.
+        """
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT ts, grid, PV, load FROM samples "
+                "WHERE ts >= ? AND ts < ? ORDER BY ts",
+                (start, end)).fetchall()
+
+
+    def get_states(self, start: float, end: float) -> list[tuple]:
+        """
+        Return (ts, state) rows with start <= ts < end.
+        """
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT ts, state FROM states "
+                "WHERE ts >= ? AND ts < ? ORDER BY ts",
+                (start, end)).fetchall()
+
+
+    def get_rollups(self, res: str, start: float, end: float) -> list[dict]:
+        """
+        Return rollups of the given resolution with start <= bucket < end.
+        """
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT * FROM rollups "
+                "WHERE res = ? AND start >= ? AND start < ? ORDER BY start",
+                (res, start, end)).fetchall()
+
+        return [dict(zip(ROLLUP_COLUMNS, row)) for row in rows]
+
+
+    def get_history(self, start: float, end: float, points: int = 500,
+                    res: str = "auto") -> dict[str, list]:
+        """
+        Return a time series between start and end reduced to at most points
+        buckets. Every bucket holds the mean, min and max of each field, so
+        short spikes survive the downsampling.
+
+        :param res: raw, minute, hour or day. Auto picks the coarsest source
+            that still has enough resolution for the requested points.
+
+        :return dict: columns ts, {field}_mean, {field}_min, {field}_max and
+            for rollups also the integrated energy in Wh.
+        """
+        points = max(1, points)
+        step = max((end - start) / points, 1e-3)
+
+        if res == "auto":
+            res = "raw"
+            for name, width in (("minute", 60), ("hour", 3600),
+                                ("day", 86400)):
+                if step >= width:
+                    res = name
+
+        stats = []
+        if res == "raw":
+            for key in FIELDS:
+                stats.append(f"AVG({key}), MIN({key}), MAX({key})")
+            query = (
+                f"SELECT MIN(ts), {', '.join(stats)} FROM samples "
+                "WHERE ts >= ? AND ts < ? GROUP BY CAST((ts - ?) / ? AS INT) "
+                "ORDER BY 1")
+            params = (start, end, start, step)
+            energy = ()
+
+        elif res in RESOLUTIONS:
+            for key in FIELDS:
+                stats.append(f"SUM({key}_mean * n) / SUM(n), "
+                             f"MIN({key}_min), MAX({key}_max)")
+            energy = ("import_wh", "export_wh", "self_wh")
+            stats.extend(f"SUM({col})" for col in energy)
+            query = (
+                f"SELECT MIN(start), {', '.join(stats)} FROM rollups "
+                "WHERE res = ? AND start >= ? AND start < ? "
+                "GROUP BY CAST((start - ?) / ? AS INT) ORDER BY 1")
+            params = (res, start, end, start, step)
+
+        else:
+            raise ValueError(f"Unknown resolution {res}!")
+
+        with self._db_lock:
+            rows = self._db.execute(query, params).fetchall()
+
+        columns = ["ts"]
+        for key in FIELDS:
+            columns.extend((f"{key}_mean", f"{key}_min", f"{key}_max"))
+        columns.extend(energy)
+
+        history = {"resolution": res}
+        for name, values in zip(columns, zip(*rows)):
+            history[name] = list(values)
+        for name in columns:
+            history.setdefault(name, [])
+
+        return history
+
+
+    def collect(self, out: MetricsWriter):
+        out.add("counter", "solar_history_duplicates_total",
+                "Samples not stored because they were already received",
+                [(None, self.duplicates)])
+
+
+    def schedule(self, scheduler: Scheduler):
+        """
+        Register the flush job every history_flush seconds and an hourly
+        prune that also runs once at startup.
+        """
+        self.scheduler = scheduler
+        self._flush_job = scheduler.every(
+            self.config.history_flush, partial(asyncio.to_thread, self.flush),
+            "history_flush")
+        scheduler.every(3600, partial(asyncio.to_thread, self.prune),
+                        "history_prune", immediate=True)
+
+
+    def reconfigure(self, config: SysConfig) -> bool:
+        """
+        Apply a new config in place.
+
+        :return bool: always True, no setting needs a restart
+        """
+        old, self.config = self.config, config
+        self.rollups.max_gap = config.connection_timeout
+        if config.history_flush != old.history_flush and self.scheduler:
+            self.scheduler.reschedule(self._flush_job, config.history_flush)
+
+        return True
+
+
+    def stop(self):
+        self.flush()
+        with self._db_lock:
+            self._db.close()
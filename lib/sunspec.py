@@ -0,0 +1,254 @@
+import struct
+from typing import NamedTuple, Sequence
+
+
+
+class Point(NamedTuple):
+    """
+    A single value in the inverter/meter register map.
+
+    name: key under which the decoded value is returned
+    address: modbus address of the first register
+    kind: int16, uint16, enum16, sunssf, int32, uint32, acc32 or bitfield32
+    scale: name of the scale factor point applied to the value, if any
+    """
+    name: str
+    address: int
+    kind: str = "int16"
+    scale: str | None = None
+
+
+
+class ReadBlock(NamedTuple):
+    """
+    A contiguous range of registers read with one read_holding_registers
+    call together with the points it contains.
+    """
+    address: int
+    count: int
+    points: tuple[Point, ...]
+
+
+
+SIZES = {
+    "int16": 1,
+    "uint16": 1,
+    "enum16": 1,
+    "sunssf": 1,
+    "int32": 2,
+    "uint32": 2,
+    "acc32": 2,
+    "bitfield32": 2
+}
+
+# struct codes for a big endian register image
+CODES = {
+    "int16": "h",
+    "uint16": "H",
+    "enum16": "H",
+    "sunssf": "h",
+    "int32": "i",
+    "uint32": "I",
+    "acc32": "I",
+    "bitfield32": "I"
+}
+
+# "not implemented" values as defined by the SunSpec specification
+NOT_IMPLEMENTED = {
+    "int16": -0x8000,
+    "uint16": 0xFFFF,
+    "enum16": 0xFFFF,
+    "sunssf": -0x8000,
+    "int32": -0x80000000,
+    "uint32": 0xFFFFFFFF,
+    "acc32": 0,
+    "bitfield32": 0xFFFFFFFF
+}
+
+# valid scale factors, anything else is treated as a read error
+POW10 = {sf: 10.0**sf for sf in range(-10, 11)}
+
+# modbus TCP allows up to 125 registers per read request
+MAX_REGISTERS = 125
+
+
+
+def plan_reads(points: tuple[Point, ...] | list[Point], max_gap: int = 16,
+               max_span: int = MAX_REGISTERS) -> list[ReadBlock]:
+    """
+    Merge points into the minimal number of read requests.
+
+    :param points: points to be read.
+    :param max_gap: largest number of unused registers that may be read to
+        join two neighbouring points into one request.
+    :param max_span: largest number of registers in one request.
+
+    :return list[ReadBlock]: read requests sorted by address.
+    """
+    max_span = min(max_span, MAX_REGISTERS)
+    blocks = []
+    start, end, members = None, None, []
+
+    for point in sorted(points, key=lambda p: p.address):
+        p_end = point.address + SIZES[point.kind]
+
+        if start is not None and (
+            point.address - end <= max_gap and p_end - start <= max_span):
+            end = max(end, p_end)
+            members.append(point)
+            continue
+
+        if start is not None:
+            blocks.append(ReadBlock(start, end - start, tuple(members)))
+
+        start, end, members = point.address, p_end, [point]
+
+    if start is not None:
+        blocks.append(ReadBlock(start, end - start, tuple(members)))
+
+    return blocks
+
+
+
+class SunSpecModel:
+    """
+    Decoder for a fixed layout SunSpec model. Point addresses are offsets
+    from the model ID register. The whole model is decoded in a single
+    struct call and scale factors are applied per scale factor group.
+    """
+    def __init__(self, name: str, ids: tuple[int, ...],
+                 points: tuple[Point, ...]):
+        self.name = name
+        self.ids = ids
+        self.points = tuple(sorted(points, key=lambda p: p.address))
+        self.size = max(p.address + SIZES[p.kind] for p in self.points)
+
+        fmt, pos = ">", 0
+        for point in self.points:
+            if point.address > pos:
+                fmt += f"{2*(point.address - pos)}x"
+            fmt += CODES[point.kind]
+            pos = point.address + SIZES[point.kind]
+
+        self._pack = struct.Struct(f">{self.size}H")
+        self._unpack = struct.Struct(fmt)
+        self._sentinels = tuple(NOT_IMPLEMENTED[p.kind] for p in self.points)
+
+        index = {p.name: i for i, p in enumerate(self.points)}
+        groups: dict[int, list[int]] = {}
+        for i, point in enumerate(self.points):
+            if point.scale is not None:
+                groups.setdefault(index[point.scale], []).append(i)
+        self._scaled = tuple((sf, tuple(idx)) for sf, idx in groups.items())
+
+        self.record = NamedTuple(
+            name.capitalize() + "Record",
+            [(p.name, float | int | None) for p in self.points])
+
+
+    def points_at(self, base: int) -> tuple[Point, ...]:
+        """
+        Return the points with absolute addresses for a model at base.
+        """
+        return tuple(p._replace(address=base + p.address)
+                     for p in self.points)
+
+
+    def decode(self, registers: Sequence[int]):
+        """
+        Decode a register block starting at the model ID register.
+
+        :return record: values with scale factors applied. Not implemented
+            points are None.
+        :return None: if the block is too short or the model ID is unknown.
+        """
+        if len(registers) < self.size:
+            return None
+
+        raw = self._unpack.unpack(self._pack.pack(*registers[:self.size]))
+        values = [None if v == na else v
+                  for v, na in zip(raw, self._sentinels)]
+
+        if values[0] not in self.ids:
+            return None
+
+        for sf, idx in self._scaled:
+            mul = POW10.get(values[sf])
+            for i in idx:
+                v = values[i]
+                values[i] = None if v is None or mul is None else v * mul
+
+        return self.record(*values)
+
+
+
+def _phases(name: str, address: int, kind: str, scale: str | None,
+            suffixes: tuple[str, ...] = ("", "phA", "phB", "phC")
+            ) -> tuple[Point, ...]:
+    size = SIZES[kind]
+    return tuple(Point(name + sfx, address + i*size, kind, scale)
+                 for i, sfx in enumerate(suffixes))
+
+
+
+# inverter models 101 (single phase), 102 (split phase), 103 (three phase)
+INVERTER = SunSpecModel("inverter", (101, 102, 103), (
+    Point("ID", 0, "uint16"),
+    Point("L", 1, "uint16"),
+    *_phases("A", 2, "uint16", "A_SF"),
+    Point("A_SF", 6, "sunssf"),
+    *_phases("PPV", 7, "uint16", "V_SF", ("phAB", "phBC", "phCA")),
+    *_phases("PhV", 10, "uint16", "V_SF", ("phA", "phB", "phC")),
+    Point("V_SF", 13, "sunssf"),
+    Point("W", 14, "int16", "W_SF"),
+    Point("W_SF", 15, "sunssf"),
+    Point("Hz", 16, "uint16", "Hz_SF"),
+    Point("Hz_SF", 17, "sunssf"),
+    Point("VA", 18, "int16", "VA_SF"),
+    Point("VA_SF", 19, "sunssf"),
+    Point("VAr", 20, "int16", "VAr_SF"),
+    Point("VAr_SF", 21, "sunssf"),
+    Point("PF", 22, "int16", "PF_SF"),
+    Point("PF_SF", 23, "sunssf"),
+    Point("WH", 24, "acc32", "WH_SF"),
+    Point("WH_SF", 26, "sunssf"),
+    Point("DCA", 27, "uint16", "DCA_SF"),
+    Point("DCA_SF", 28, "sunssf"),
+    Point("DCV", 29, "uint16", "DCV_SF"),
+    Point("DCV_SF", 30, "sunssf"),
+    Point("DCW", 31, "int16", "DCW_SF"),
+    Point("DCW_SF", 32, "sunssf"),
+    *_phases("Tmp", 33, "int16", "Tmp_SF", ("Cab", "Snk", "Trns", "Ot")),
+    Point("Tmp_SF", 37, "sunssf"),
+    Point("St", 38, "enum16"),
+    Point("StVnd", 39, "enum16"),
+    Point("Evt1", 40, "bitfield32"),
+    Point("Evt2", 42, "bitfield32"),
+    *_phases("EvtVnd", 44, "bitfield32", None, ("1", "2", "3", "4"))
+))
+
+
+# meter models 201 (single phase), 202 (split phase), 203 (three phase wye),
+# 204 (three phase delta)
+METER = SunSpecModel("meter", (201, 202, 203, 204), (
+    Point("ID", 0, "uint16"),
+    Point("L", 1, "uint16"),
+    *_phases("A", 2, "int16", "A_SF"),
+    Point("A_SF", 6, "sunssf"),
+    *_phases("PhV", 7, "int16", "V_SF"),
+    *_phases("PPV", 11, "int16", "V_SF", ("", "phAB", "phBC", "phCA")),
+    Point("V_SF", 15, "sunssf"),
+    Point("Hz", 16, "int16", "Hz_SF"),
+    Point("Hz_SF", 17, "sunssf"),
+    *_phases("W", 18, "int16", "W_SF"),
+    Point("W_SF", 22, "sunssf"),
+    *_phases("VA", 23, "int16", "VA_SF"),
+    Point("VA_SF", 27, "sunssf"),
+    *_phases("VAR", 28, "int16", "VAR_SF"),
+    Point("VAR_SF", 32, "sunssf"),
+    *_phases("PF", 33, "int16", "PF_SF"),
+    Point("PF_SF", 37, "sunssf"),
+    *_phases("TotWhExp", 38, "acc32", "TotWh_SF"),
+    *_phases("TotWhImp", 46, "acc32", "TotWh_SF"),
+    Point("TotWh_SF", 54, "sunssf")
+))
@@ -1,21 +1,30 @@
 from enum import Enum, auto
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, TypeAdapter, field_validator
 import json
+import struct
 from pathlib import Path
 import os
 import logging
 import logging.config
+import logging.handlers
+import queue
+import threading
+import atexit
+from typing import Literal
 
 
 CONFIG_DIR = Path(__file__).resolve().parents[1] / "config"
+DATA_DIR = Path(__file__).resolve().parents[1] / "data"
 
 
 
 class SysConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     mode: str = "Simulator" # RPI-setup
     alarm_pin: str = "J8:3"
     relay_pins: str = "J8:11; J8:13" # list of pins GPIO pins to use, separated by ;
-    cycle_time: int = 5
+    cycle_time: int = 5 # decision is re-evaluated at least every N seconds
     invert_logic: bool = False
     connection_timeout: int = 300 # After N seconds the load value resets to 0 in DecisionMaker
     relay_timeout : int = 300 # relays switch after N seconds after going bellow lower lim    
@@ -28,23 +37,95 @@ class SysConfig(BaseModel):
     limit_3 : int = 5000 # alarm goes up when this limit is passed
     limit_4 : int = 5000 # alarm goes up when this limit is passed
     limit_5 : int = 5000 # alarm goes up when this limit is passed
+    history_flush : int = 10 # buffered samples are written every N seconds
+    history_retention : int = 365 # samples older than N days are deleted
+    tariff_file : str = "tariffs/si.json" # tariff calendar, relative to the config dir
+
+
+
+class ModbusSource(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    name: str = "" # label in logs and metrics, defaults to ip:port/unit
+    ip: str = "192.168.1.45"
+    port: int = 1502
+    unit: int = 1 # modbus unit (device) id
+    inverter_base: int | None = 69 # address of the inverter SunSpec model ID, None if absent
+    meter_base: int | None = 188 # address of the meter SunSpec model ID, None if absent
 
 
 
 class ModbusConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     ip: str = "192.168.1.45"
     port: int = 1502
     timeout: int = 5
-    acq_time: int = 30
+    acq_time: float = 30
+    connect_delay: float = 0.3 # wait after a fresh connection before reading
+    reconnect_min: float = 1 # first reconnect backoff in seconds
+    reconnect_max: float = 60 # backoff is doubled up to this value
+    max_gap: int = 16 # unused registers allowed to merge two reads into one
+    max_span: int = 125 # max registers in a single read request
+    inverter_base: int = 69 # address of the inverter SunSpec model ID
+    meter_base: int = 188 # address of the meter SunSpec model ID
+    fast_sampling: bool = False # poll every fast_acq_time and downsample
+    fast_acq_time: float = 0.5
+    publish_time: float = 1 # publisher/decision rate in fast sampling mode
+    publish_stat: Literal["mean", "min", "max", "last", "peak"] = "peak"
+    broadcast_time: float = 5 # websocket rate in fast sampling mode
+    sources: tuple[ModbusSource, ...] = () # devices to poll, empty uses ip/port above
+    host_concurrency: int = 1 # parallel requests per host
+    source_timeout: float = 10 # max time for reading one source per cycle
+    restart_after: float = 330 # s without a valid sample before the service exits
 
 
 
 class MqttConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     broker_ip: str = "192.168.1.54" # broker ip
     username: str = "username"
     password: str = "password"
     port: int = 1883
     topic: str = "Power"
+    connect_timeout: float = 5 # s, per broker connection attempt
+    queue_size: int = 1000 # received messages waiting for the event loop
+    wire_format: Literal["json", "binary"] = "json" # must match on both sides
+    outbox_size: int = 100000 # samples buffered while the broker is down
+    backfill_batch: int = 100 # buffered samples sent per backfill message
+    live_qos: int = 1 # QoS of the live control topic
+    live_retain: bool = False # retain the latest live sample on the broker
+    history_interval: float = 0 # batch all samples to <topic>/history every N seconds, 0 disables
+    history_batch: int = 60 # max samples per history message
+    history_qos: int = 1
+
+
+
+class TariffConfig(BaseModel):
+    version: int = 1 # format version of the tariff file
+    name: str = "flat"
+    zones: list[int] = [0] # start hours of the daily time zones
+    seasons: dict[str, list[int]] = {"all": list(range(1, 13))} # season -> months
+    blocks: dict[str, dict[str, list[int]]] = {
+        "all": {"workday": [1], "free": [1]}} # season -> workday/free -> block per zone
+    holidays: list[str] = [] # free days as MM-DD or YYYY-MM-DD
+    easter_holidays: list[int] = [] # free days as offsets from Easter Sunday
+    limits: list[int] = [] # power limit per block, empty uses limit_1 .. limit_5
+
+
+    @field_validator("zones")
+    @classmethod
+    def _zones_ascending(cls, zones: list[int]) -> list[int]:
+        # the block rows are indexed in the order of the zones
+        if any(a >= b for a, b in zip(zones, zones[1:])):
+            raise ValueError("Tariff zones must be strictly ascending")
+        return zones
+
+
+
+# newest tariff file format this build understands
+TARIFF_VERSION = 1
 
 
 
@@ -60,6 +141,15 @@ class TransferData(BaseModel):
     PV: int = 0
     load: int = 0
     status: str = "NA"
+    voltage: float = 0 # inverter AC voltage, phase A
+    frequency: float = 0
+    temperature: float = 0 # inverter heat sink temperature
+    PV_energy: int = 0 # lifetime inverter energy in Wh
+    export_energy: int = 0 # meter total exported energy in Wh
+    import_energy: int = 0 # meter total imported energy in Wh
+    inverter_status: int = 0 # SunSpec operating state
+    ts: float = 0 # acquisition time as unix time, 0 if unknown
+    seq: int = 0 # sequence number, renumbered by the MQTT publisher, 0 if unknown
 
 
 
@@ -72,6 +162,106 @@ class State(Enum):
 
 
 
+# packed TransferData: grid, PV, load, status index, voltage, frequency,
+# temperature, PV_energy, export_energy, import_energy, inverter_status, ts,
+# seq
+TRANSFER_STRUCT = struct.Struct("<iiiBfffIIIHdI")
+STATUS_NAMES = ("NA", *(state.name for state in State))
+
+
+
+def pack_transfer_data(data: TransferData) -> bytes:
+    """
+    Pack TransferData into a fixed 51 byte little endian record. Unknown
+    status strings are sent as 255.
+    """
+    try:
+        status = STATUS_NAMES.index(data.status)
+    except ValueError:
+        status = 255
+
+    return TRANSFER_STRUCT.pack(
+        data.grid, data.PV, data.load, status, data.voltage, data.frequency,
+        data.temperature, data.PV_energy, data.export_energy,
+        data.import_energy, data.inverter_status, data.ts,
+        data.seq & 0xFFFFFFFF)
+
+
+
+def unpack_transfer_data(payload: bytes) -> TransferData:
+    """
+    Inverse of pack_transfer_data. The struct layout already guarantees the
+    field types, so pydantic validation is skipped.
+    """
+    (grid, PV, load, status, voltage, frequency, temperature, PV_energy,
+     export_energy, import_energy, inverter_status, ts, seq
+     ) = TRANSFER_STRUCT.unpack(payload)
+
+    return TransferData.model_construct(
+        grid=grid, PV=PV, load=load,
+        status=STATUS_NAMES[status] if status < len(STATUS_NAMES) else "NA",
+        voltage=voltage, frequency=frequency, temperature=temperature,
+        PV_energy=PV_energy, export_energy=export_energy,
+        import_energy=import_energy, inverter_status=inverter_status, ts=ts,
+        seq=seq)
+
+
+
+def encode_transfer_data(data: TransferData, wire_format: str) -> bytes:
+    """
+    Encode TransferData for MQTT in the given wire format.
+    """
+    if wire_format == "binary":
+        return pack_transfer_data(data)
+
+    return data.model_dump_json().encode()
+
+
+
+def decode_transfer_data(payload: bytes, wire_format: str) -> TransferData:
+    """
+    Decode an MQTT payload. JSON is validated directly from bytes without
+    an intermediate str or dict.
+    """
+    if wire_format == "binary":
+        return unpack_transfer_data(payload)
+
+    return TransferData.model_validate_json(payload)
+
+
+
+_BATCH_ADAPTER = TypeAdapter(list[TransferData])
+
+
+
+def encode_batch(batch: list[TransferData], wire_format: str) -> bytes:
+    """
+    Encode several samples into one MQTT payload. JSON batches are a list,
+    binary batches are concatenated records.
+    """
+    if wire_format == "binary":
+        return b"".join(pack_transfer_data(data) for data in batch)
+
+    return _BATCH_ADAPTER.dump_json(batch)
+
+
+
+def decode_batch(payload: bytes, wire_format: str) -> list[TransferData]:
+    """
+    Inverse of encode_batch.
+    """
+    if wire_format == "binary":
+        size = TRANSFER_STRUCT.size
+        if len(payload) % size:
+            raise ValueError(f"Batch length {len(payload)} is not a "
+                             f"multiple of {size}")
+        return [unpack_transfer_data(payload[i:i + size])
+                for i in range(0, len(payload), size)]
+
+    return _BATCH_ADAPTER.validate_json(payload)
+
+
+
 def load_json(filename: str) -> dict:
     """
     Load config stored as json object.
@@ -86,21 +276,118 @@ def load_json(filename: str) -> dict:
 
 
 
+class ConfigStore:
+    """
+    Cache of the parsed config files. A file is only read and validated
+    again when it changed on disk. The configs are frozen models, so the
+    cached instance is handed out as an immutable snapshot.
+    """
+    FILES = {
+        SysConfig: "sys_config.json",
+        MqttConfig: "mqtt_config.json",
+        ModbusConfig: "modbus_config.json"
+    }
+
+
+    def __init__(self, config_dir: Path = CONFIG_DIR):
+        self.config_dir = config_dir
+        self._cache: dict[type, tuple[tuple | None, BaseModel]] = {}
+        self._lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.loads = 0
+
+
+    def _filename(self, cls: type) -> Path:
+        if cls not in self.FILES:
+            raise TypeError(f"Received unxpected type of {cls}!")
+        return self.config_dir / self.FILES[cls]
+
+
+    @staticmethod
+    def _version(filename: Path) -> tuple | None:
+        """
+        Identify the file content without reading it. A rename gives a new
+        inode, so atomic writes are detected even within the mtime
+        resolution.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+    def get(self, cls: type[BaseModel]) -> BaseModel:
+        """
+        Return the config of type cls. If the file doesn't exist or fails
+        to load, an instance with default parameters is returned.
+        """
+        filename = self._filename(cls)
+        version = self._version(filename)
+
+        with self._lock:
+            cached = self._cache.get(cls)
+            if cached is not None and cached[0] == version:
+                self.hits += 1
+                return cached[1]
+
+        config = cls()
+        if version is not None:
+            try:
+                config = cls(**load_json(filename))
+            except Exception as error:
+                print(f"Failed to load json file:\n{error}\nUsing default values.")
+
+        with self._lock:
+            self.loads += 1
+            self._cache[cls] = (version, config)
+
+        return config
+
+
+    def save(self, data: BaseModel):
+        """
+        Write the config to a temporary file, fsync it and rename it over
+        the old one, so a power loss leaves either the old or the new file.
+        """
+        filename = self._filename(type(data))
+        tmp = filename.with_name(filename.name + ".tmp")
+
+        with open(tmp, "w") as file:
+            file.write(data.model_dump_json(ensure_ascii=False, indent=4))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, filename)
+
+        # persist the rename itself
+        fd = os.open(filename.parent, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        with self._lock:
+            self._cache[type(data)] = (self._version(filename), data)
+
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "loads": self.loads}
+
+
+
+CONFIGS = ConfigStore()
+
+
+
 def load_sys_config() -> SysConfig:
     """
     Load config stored as an UserConfig object.
     If file doesn't exist or fails to load, it returns an UserConfig instance
     with default parameters.
     """
-    filename = CONFIG_DIR / "sys_config.json"
-    if os.path.exists(filename):
-        try:
-            config = load_json(filename)
-            return SysConfig(**config)
-        except Exception as error:
-            print(f"Failed to load json file:\n{error}\nUsing default values.")
-    
-    return SysConfig()
+    return CONFIGS.get(SysConfig)
 
 
 
@@ -110,15 +397,7 @@ def load_mqtt_config() -> MqttConfig:
     If file doesn't exist or fails to load, it returns an UserConfig instance
     with default parameters.
     """
-    filename = CONFIG_DIR / "mqtt_config.json"
-    if os.path.exists(filename):
-        try:
-            config = load_json(filename)
-            return MqttConfig(**config)
-        except Exception as error:
-            print(f"Failed to load json file:\n{error}\nUsing default values.")
-    
-    return MqttConfig()
+    return CONFIGS.get(MqttConfig)
 
 
 
@@ -128,15 +407,24 @@ def load_modbus_config() -> ModbusConfig:
     If file doesn't exist or fails to load, it returns an UserConfig instance
     with default parameters.
     """
-    filename = CONFIG_DIR / "modbus_config.json"
-    if os.path.exists(filename):
-        try:
-            config = load_json(filename)
-            return ModbusConfig(**config)
-        except Exception as error:
-            print(f"Failed to load json file:\n{error}\nUsing default values.")
-    
-    return ModbusConfig()
+    return CONFIGS.get(ModbusConfig)
+
+
+
+def load_tariff_config(filename: str | Path) -> TariffConfig:
+    """
+    Load a tariff calendar. Unlike the other configs errors are raised, so
+    a broken file never silently replaces a working tariff.
+
+    :param filename: path of the file, relative paths are taken from the
+        config dir.
+    """
+    config = TariffConfig(**load_json(CONFIG_DIR / filename))
+    if config.version > TARIFF_VERSION:
+        raise ValueError(
+            f"Tariff file version {config.version} is not supported")
+
+    return config
 
 
 
@@ -147,20 +435,157 @@ def update_config(data: MqttConfig | SysConfig | ModbusConfig) -> None:
     :param data: Input data to save as json file.
     :type data: MqqtConfig | UserConfig
     """
+    CONFIGS.save(data)
+
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that leaves flushing to the LogPipeline, which
+    flushes once per batch of records instead of after every record.
+    """
+    def flush(self):
+        pass
+
+
+    def sync(self):
+        super().flush()
+
+
+    def close(self):
+        self.sync()
+        super().close()
+
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records of one logger on the pipeline queue. Never blocks, a
+    full queue drops the record.
+    """
+    # args of these types can't change before the listener formats them
+    LAZY_TYPES = (str, int, float, bool, bytes, type(None), Enum)
+
+
+    def __init__(self, pipeline: "LogPipeline", route: str):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+        self.route = route
+
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Leave formatting to the listener thread unless an argument is a
+        mutable object that could change in the meantime.
+        """
+        args = record.args
+        if isinstance(args, dict):
+            args = args.values()
+        if args and not all(isinstance(a, self.LAZY_TYPES) for a in args):
+            record.msg = record.getMessage()
+            record.args = None
+
+        return record
+
+
+    def enqueue(self, record: logging.LogRecord):
+        # the last 10 % of the queue are kept for warnings and errors
+        if record.levelno < logging.WARNING and (
+            self.queue.qsize() >= 0.9 * self.queue.maxsize):
+            self.pipeline.dropped += 1
+            return
+
+        try:
+            self.queue.put_nowait((self.route, record))
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+
+
+class LogPipeline:
+    """
+    Moves log handling off the event loop. The configured loggers only put
+    records on a bounded queue and a background thread formats and writes
+    them with the handlers from the logging config, flushing the files once
+    per batch.
+    """
+    def __init__(self, size: int = 10000, batch: int = 200):
+        self.queue: queue.Queue = queue.Queue(size)
+        self.batch = batch
+        self.routes: dict[str, list[logging.Handler]] = {}
+        self._thread: threading.Thread | None = None
+
+        # counters
+        self.handled = 0
+        self.dropped = 0
+
+
+    def install(self, names: list[str]):
+        """
+        Replace the handlers of the named loggers ("" is the root logger)
+        with queue handlers and start the listener thread.
+        """
+        for name in names:
+            logger = logging.getLogger(name or None)
+            self.routes[name] = list(logger.handlers)
+            for handler in self.routes[name]:
+                logger.removeHandler(handler)
+            logger.addHandler(_QueueHandler(self, name))
+
+        self._thread = threading.Thread(
+            target=self._run, name="log-listener", daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Write the queued records and stop the listener thread.
+        """
+        if self._thread is None:
+            return
+
+        self.queue.put((None, None))
+        self._thread.join()
+        self._thread = None
+
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for route, record in batch:
+                if record is None:
+                    running = False
+                    continue
+
+                for handler in self.routes.get(route, ()):
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                self.handled += 1
+
+            for handlers in self.routes.values():
+                for handler in handlers:
+                    if isinstance(handler, BufferedRotatingFileHandler):
+                        handler.sync()
+
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "handled": self.handled,
+            "dropped": self.dropped
+        }
+
 
-    if isinstance(data, SysConfig):
-        filename = CONFIG_DIR / "sys_config.json"
-    elif isinstance(data, MqttConfig):
-        filename = CONFIG_DIR / "mqtt_config.json"
-    elif isinstance(data, ModbusConfig):
-        filename = CONFIG_DIR / "modbus_config.json"
-    else:
-        raise TypeError(f"Received unxpected type of {type(data)}!")
-    
-    data_json = data.model_dump_json(ensure_ascii=False, indent=4)
 
-    with open(filename, "w") as file:
-        file.write(data_json)
+LOGGING = LogPipeline()
+atexit.register(LOGGING.stop)
 
 
 
@@ -174,4 +599,7 @@ def setup_logging(LOG_DIR):
     config['handlers']['file_err']['filename'] = str(LOG_DIR / 'error.log')
     config['handlers']['file_data']['filename'] = str(LOG_DIR / 'data.log')
 
-    logging.config.dictConfig(config)
\ No newline at end of file
+    # dictConfig closes the handlers, so the old listener must be done first
+    LOGGING.stop()
+    logging.config.dictConfig(config)
+    LOGGING.install([*config.get("loggers", {}), ""])
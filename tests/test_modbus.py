@@ -0,0 +1,181 @@
+import asyncio
+import time
+
+import pytest
+
+from lib.core import SolarEdgeModbus
+from lib.scheduler import Scheduler
+from lib.sunspec import INVERTER, METER
+from lib.utils import ModbusConfig, ModbusSource
+
+
+
+class Sink:
+    """
+    Stand-in for the DecisionMaker or MqqtPublisher.
+    """
+    def __init__(self):
+        self.samples = []
+
+
+    def update_value(self, data):
+        self.samples.append(data)
+
+
+
+def record(model, **values):
+    fields = dict.fromkeys(model.record._fields)
+    fields.update(values)
+    return model.record(**fields)
+
+
+def fake_read(device, result, inverter=None, meter=None):
+    """
+    Replace the modbus read of a device with a fixed result.
+    """
+    async def read():
+        device.inverter, device.meter = inverter, meter
+        return result
+
+    device.read = read
+
+
+def run(coro_fn, **config):
+    """
+    Create a SolarEdgeModbus inside an event loop, the pymodbus client
+    needs one, and pass it to coro_fn.
+    """
+    async def main():
+        m = SolarEdgeModbus(ModbusConfig(**config), Sink())
+        try:
+            return await coro_fn(m)
+        finally:
+            m.stop()
+
+    return asyncio.run(main())
+
+
+
+def test_exit_is_time_based():
+    async def check(m):
+        fake_read(m.devices[0], False)
+        # many failed fast cycles within restart_after are tolerated
+        for _ in range(100):
+            await m.get_new_data()
+        assert m._error_counter == 100
+
+        m._last_valid -= 61
+        with pytest.raises(SystemExit):
+            await m.get_new_data()
+
+    run(check, fast_sampling=True, fast_acq_time=0.5, restart_after=60)
+
+
+def test_valid_sample_resets_exit_timer():
+    async def check(m):
+        device = m.devices[0]
+        m._last_valid -= 50
+        fake_read(device, True, record(INVERTER, ID=103, W=1000),
+                  record(METER, ID=203, W=200))
+        assert await m.get_new_data()
+
+        fake_read(device, False)
+        m._last_valid -= 50
+        assert not await m.get_new_data()
+
+    run(check, restart_after=60)
+
+
+def test_reconfigure_during_poll():
+    async def check(m):
+        scheduler = Scheduler()
+        m.schedule(scheduler)
+        old = m.devices[0]
+        reads = []
+
+        async def slow_read():
+            reads.append(time.monotonic())
+            await asyncio.sleep(0.3)
+            return True
+
+        old.read = slow_read
+        runner = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.02)
+        assert len(reads) == 1
+
+        t = time.monotonic()
+        await m.reconfigure(m.config.model_copy(
+            update={"port": 1, "acq_time": 0.1}))
+        # the poll in progress was cancelled, not waited for
+        assert time.monotonic() - t < 0.1
+        assert m.devices[0] is not old
+        assert m._poll_job.period == 0.1
+        assert [job.name for job in scheduler.jobs] == ["modbus"]
+
+        await asyncio.sleep(0.3)
+        # no poll was started on the old devices after the reconfigure
+        assert len(reads) == 1
+        assert m._poll_job.runs >= 2
+        scheduler.stop()
+        await runner
+
+    run(check, ip="127.0.0.1", acq_time=0.05)
+
+
+def test_reconfigure_without_device_change_keeps_connections():
+    async def check(m):
+        scheduler = Scheduler()
+        m.schedule(scheduler)
+        connections = dict(m.connections)
+        job = m._poll_job
+
+        await m.reconfigure(m.config.model_copy(update={"reconnect_max": 7}))
+        assert m._poll_job is job
+
+        await m.reconfigure(m.config.model_copy(update={"acq_time": 5}))
+        assert m.connections == connections
+        assert m._poll_job is not job and job.cancelled
+        assert all(c.config.acq_time == 5 for c in connections.values())
+        scheduler.stop()
+
+    run(check)
+
+
+SOURCES = (ModbusSource(name="a", ip="127.0.0.1", port=1),
+           ModbusSource(name="b", ip="127.0.0.1", port=2, meter_base=None))
+
+
+def test_sources_are_merged():
+    async def check(m):
+        a, b = m.devices
+        fake_read(a, True,
+                  record(INVERTER, ID=103, W=3000, WH=1000, TmpSnk=40,
+                         PhVphA=230, Hz=50),
+                  record(METER, ID=203, W=-500, TotWhExp=10, TotWhImp=20))
+        fake_read(b, True, record(INVERTER, ID=103, W=1500, WH=500,
+                                  TmpSnk=55, PhVphA=231, Hz=49))
+
+        assert await m.get_new_data()
+        assert (m.PV_power, m.grid_power, m.current_load) == (4500, -500, 5000)
+
+        data = m._transfer_data()
+        assert (data.PV_energy, data.temperature) == (1500, 55)
+        assert (data.export_energy, data.import_energy) == (10, 20)
+        # AC values come from the first inverter
+        assert (data.voltage, data.frequency) == (230, 50)
+
+    run(check, sources=SOURCES)
+
+
+def test_invalid_source_invalidates_cycle():
+    async def check(m):
+        a, b = m.devices
+        fake_read(a, True, record(INVERTER, ID=103, W=3000),
+                  record(METER, ID=203, W=-500))
+        fake_read(b, False)
+
+        assert not await m.get_new_data()
+        assert (m.PV_power, m.grid_power, m.current_load) == (0, 0, 0)
+        assert m.errors == 1
+
+    run(check, sources=SOURCES)
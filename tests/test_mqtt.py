@@ -0,0 +1,157 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import lib.core
+from lib.core import MqqtPublisher, MqqtSubscriber
+from lib.storage import SampleStore
+from lib.utils import MqttConfig, SysConfig, TransferData, encode_transfer_data
+
+
+
+class Sink:
+    """
+    Stand-in for the DecisionMaker and the SampleStore.
+    """
+    def __init__(self):
+        self.samples = []
+
+
+    def update_value(self, data):
+        self.samples.append(data)
+
+
+    def add_sample(self, data):
+        self.samples.append(data)
+
+
+
+class FakeClient:
+    """
+    Connected paho client that records publishes instead of sending.
+    """
+    def __init__(self):
+        self.published = []
+
+
+    def is_connected(self) -> bool:
+        return True
+
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload))
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS)
+
+
+    def disconnect(self):
+        pass
+
+
+    def loop_stop(self):
+        pass
+
+
+
+def message(topic: str, payload: bytes):
+    return SimpleNamespace(topic=topic, payload=payload)
+
+
+@pytest.fixture
+def publisher(tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.core, "DATA_DIR", tmp_path)
+    publisher = MqqtPublisher(MqttConfig())
+    publisher.client = FakeClient()
+    yield publisher
+    publisher.stop()
+
+
+def subscriber(store=None, **config) -> tuple[MqqtSubscriber, Sink]:
+    decisions = Sink()
+    sub = MqqtSubscriber(MqttConfig(**config), decisions, store)
+    return sub, decisions
+
+
+
+def test_downsampled_seq_is_not_counted_as_missed(publisher):
+    # a peak window forwards acquisitions 2, 3, 6 and 8
+    for seq in (2, 3, 6, 8):
+        publisher.update_value(TransferData(grid=seq, ts=1000 + seq, seq=seq))
+
+    sub, decisions = subscriber()
+    for topic, payload in publisher.client.published:
+        sub.on_message(None, None, message(topic, payload))
+    sub._drain()
+
+    assert [d.seq for d in decisions.samples] == [1, 2, 3, 4]
+    assert [d.grid for d in decisions.samples] == [2, 3, 6, 8]
+    assert sub.missed == 0
+
+
+def test_gap_in_published_seq_is_missed():
+    sub, _ = subscriber()
+    for seq in (1, 2, 5):
+        payload = encode_transfer_data(TransferData(seq=seq), "json")
+        sub.on_message(None, None, message("Power", payload))
+    sub._drain()
+
+    assert sub.missed == 2
+
+
+def test_full_queue_drops_oldest():
+    sub, decisions = subscriber(queue_size=3)
+    for seq in range(1, 6):
+        payload = encode_transfer_data(TransferData(seq=seq), "json")
+        sub.on_message(None, None, message("Power", payload))
+
+    assert sub.received == 5
+    assert sub.dropped == 2
+    sub._drain()
+    assert [d.seq for d in decisions.samples] == [3, 4, 5]
+    assert sub.missed == 0
+
+
+@pytest.mark.parametrize("history_interval", [0, 60])
+def test_history_and_live_are_stored_once(tmp_path, monkeypatch,
+                                          history_interval):
+    monkeypatch.setattr(lib.core, "DATA_DIR", tmp_path)
+    publisher = MqqtPublisher(MqttConfig(history_interval=history_interval))
+    publisher.client = FakeClient()
+    for i in range(5):
+        publisher.update_value(TransferData(grid=i, ts=1000 + i))
+    publisher._publish_history()
+
+    store = SampleStore(tmp_path / "history.db", SysConfig())
+    # the subscriber doesn't know the history setting of the publisher
+    sub, decisions = subscriber(store)
+    for topic, payload in publisher.client.published:
+        sub.on_message(None, None, message(topic, payload))
+    sub._drain()
+    store.flush()
+
+    assert [row[1] for row in store.get_samples(0, 2000)] == [0, 1, 2, 3, 4]
+    assert len(decisions.samples) == 5
+    assert store.duplicates == (5 if history_interval else 0)
+    store.stop()
+    publisher.stop()
+
+
+def test_stop_ends_network_thread_without_blocking():
+    sub, _ = subscriber(broker_ip="127.0.0.1", port=1)
+
+    async def start():
+        sub.start_loop()
+
+    asyncio.run(start())
+    thread = sub.client._thread
+    assert thread is not None and thread.is_alive()
+
+    t = time.monotonic()
+    sub.stop()
+    assert time.monotonic() - t < 0.1
+    assert sub._event_loop is None
+
+    thread.join(timeout=3)
+    assert not thread.is_alive()
@@ -0,0 +1,93 @@
+import pytest
+
+from lib.storage import RingBuffer
+
+
+
+def record(i: int) -> bytes:
+    return i.to_bytes(4, "little") * 2
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "outbox.bin"
+
+
+
+def test_fifo_order(path):
+    ring = RingBuffer(path, 8, 4)
+    for i in range(3):
+        ring.append(record(i))
+
+    assert len(ring) == 3
+    assert ring.peek(2) == [record(0), record(1)]
+    ring.consume(2)
+    assert ring.peek(10) == [record(2)]
+    ring.consume(10)
+    assert len(ring) == 0
+
+
+def test_overwrites_oldest_when_full(path):
+    ring = RingBuffer(path, 8, 4)
+    for i in range(6):
+        ring.append(record(i))
+
+    assert len(ring) == 4
+    assert ring.dropped == 2
+    assert ring.peek(4) == [record(i) for i in range(2, 6)]
+
+
+def test_rejects_wrong_record_size(path):
+    ring = RingBuffer(path, 8, 4)
+
+    with pytest.raises(ValueError):
+        ring.append(b"short")
+
+
+def test_survives_reopen(path):
+    ring = RingBuffer(path, 8, 4)
+    for i in range(5):
+        ring.append(record(i))
+    ring.consume(1)
+    ring.close()
+
+    ring = RingBuffer(path, 8, 4)
+    assert ring.peek(4) == [record(i) for i in range(2, 5)]
+
+
+def test_resize_starts_empty(path):
+    ring = RingBuffer(path, 8, 4)
+    ring.append(record(0))
+    ring.close()
+
+    assert len(RingBuffer(path, 8, 8)) == 0
+
+
+def test_torn_record_is_skipped(path):
+    ring = RingBuffer(path, 8, 4)
+    for i in range(3):
+        ring.append(record(i))
+    ring.close()
+
+    # flip a payload byte of the second record as a torn write would
+    data = bytearray(path.read_bytes())
+    slot = RingBuffer.CRC.size + 8
+    offset = RingBuffer.HEADER.size + slot + RingBuffer.CRC.size
+    data[offset] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+    ring = RingBuffer(path, 8, 4)
+    assert ring.peek(3) == [record(0), record(2)]
+    assert ring.corrupt == 1
+
+
+def test_invalid_header_is_reset(path):
+    ring = RingBuffer(path, 8, 4)
+    ring.append(record(0))
+    ring.close()
+
+    data = bytearray(path.read_bytes())
+    RingBuffer.HEADER.pack_into(data, 0, 1, 5) # read ahead of write
+    path.write_bytes(bytes(data))
+
+    assert len(RingBuffer(path, 8, 4)) == 0
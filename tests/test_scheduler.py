@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import pytest
+
+from lib.scheduler import Scheduler
+
+
+
+def run_for(scheduler: Scheduler, seconds: float, during=None):
+    """
+    Run the scheduler for a while. during is an optional coroutine
+    function that runs next to it.
+    """
+    async def main():
+        task = asyncio.create_task(scheduler.run())
+        if during is not None:
+            await during()
+        await asyncio.sleep(seconds)
+        scheduler.stop()
+        await task
+
+    asyncio.run(main())
+
+
+
+def test_periodic_job_aligns_to_wall_clock():
+    scheduler = Scheduler()
+    stamps = []
+    job = scheduler.every(0.05, lambda: stamps.append(time.time()), "tick")
+    run_for(scheduler, 0.33)
+
+    assert 4 <= job.runs <= 7
+    assert all(min(t % 0.05, 0.05 - t % 0.05) < 0.02 for t in stamps)
+    assert job.lateness.count == job.runs
+
+
+def test_immediate_and_call_later():
+    scheduler = Scheduler()
+    once = []
+    job = scheduler.every(10, lambda: None, "slow", immediate=True)
+    scheduler.call_later(0.02, lambda: once.append(1))
+    run_for(scheduler, 0.1)
+
+    assert job.runs == 1
+    assert once == [1]
+
+
+def test_blocked_loop_counts_missed_ticks():
+    scheduler = Scheduler()
+    job = scheduler.every(0.05, lambda: None, "tick", align=False)
+
+    async def block():
+        await asyncio.sleep(0.01)
+        time.sleep(0.3)
+
+    run_for(scheduler, 0.1, block)
+
+    assert job.missed >= 4
+    # skipped ticks don't run late in a burst
+    assert job.runs <= 4
+
+
+def test_busy_coroutine_counts_overruns():
+    scheduler = Scheduler()
+
+    async def slow():
+        await asyncio.sleep(0.12)
+
+    job = scheduler.every(0.05, slow, "slow", align=False, immediate=True)
+    run_for(scheduler, 0.3)
+
+    assert job.overruns >= 2
+    assert job.runs + job.overruns >= 5
+    assert job.duration.count >= 1
+
+
+def test_reschedule_skips_stale_deadline():
+    scheduler = Scheduler()
+    job = scheduler.every(0.05, lambda: None, "tick", align=False)
+    scheduler.reschedule(job, 10)
+    run_for(scheduler, 0.2)
+
+    # the heap entry for the old 50 ms deadline must not fire
+    assert job.runs == 0
+    assert job.period == 10
+
+
+def test_reschedule_to_shorter_period():
+    scheduler = Scheduler()
+    job = scheduler.every(10, lambda: None, "tick", align=False)
+    scheduler.reschedule(job, 0.05)
+    run_for(scheduler, 0.28)
+
+    assert 4 <= job.runs <= 6
+
+
+def test_remove_stops_job_and_drops_stats():
+    scheduler = Scheduler()
+    job = scheduler.every(0.05, lambda: None, "tick", align=False)
+    other = scheduler.every(0.05, lambda: None, "other", align=False)
+    scheduler.remove(job)
+    run_for(scheduler, 0.15)
+
+    assert job.runs == 0
+    assert other.runs >= 2
+    assert list(scheduler.stats()) == ["other"]
+
+
+@pytest.mark.parametrize("coroutine", [False, True])
+def test_job_error_reaches_run(coroutine):
+    scheduler = Scheduler()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    async def fail_async():
+        fail()
+
+    scheduler.every(0.02, fail_async if coroutine else fail, "fail",
+                    align=False)
+
+    with pytest.raises(RuntimeError, match="boom"):
+        run_for(scheduler, 0.2)
+
+
+def test_stop_cancels_running_jobs():
+    scheduler = Scheduler()
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    job = scheduler.every(1, hang, "hang", immediate=True)
+    run_for(scheduler, 0.05)
+
+    assert job.cancelled
+    assert job.task.cancelled()
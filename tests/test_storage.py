@@ -0,0 +1,181 @@
+import time
+
+import pytest
+
+from lib.storage import RollupEngine, SampleStore, bucket_bounds
+from lib.utils import State, SysConfig, TransferData
+
+
+# an hour boundary, so minute and hour buckets start here
+T0 = 1_699_999_200.0
+
+
+
+@pytest.fixture
+def ljubljana(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Ljubljana")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SampleStore(tmp_path / "history.db", SysConfig())
+    yield store
+    store.stop()
+
+
+def sample(ts: float, grid: int = 0, PV: int = 0) -> TransferData:
+    return TransferData(grid=grid, PV=PV, load=PV - grid, ts=ts)
+
+
+def rows(engine: RollupEngine, res: str) -> list[tuple]:
+    return [row for row in engine.pop_rows() if row[0] == res]
+
+
+
+def test_bucket_bounds():
+    assert bucket_bounds("minute", T0 + 59.9) == (T0, T0 + 60)
+    assert bucket_bounds("minute", T0 + 60) == (T0 + 60, T0 + 120)
+    assert bucket_bounds("hour", T0 + 3599) == (T0, T0 + 3600)
+
+    with pytest.raises(ValueError):
+        bucket_bounds("week", T0)
+
+
+def test_day_buckets_follow_local_midnight(ljubljana):
+    # the day clocks go back has 25 hours
+    start, end = bucket_bounds("day", time.mktime(
+        (2026, 10, 25, 12, 0, 0, 0, 0, -1)))
+
+    assert time.localtime(start)[:5] == (2026, 10, 25, 0, 0)
+    assert end - start == 25 * 3600
+
+
+def test_rollup_closes_bucket_at_boundary():
+    engine = RollupEngine(max_gap=300)
+    engine.add_sample(T0 + 58, 100, 500, 400)
+    engine.add_sample(T0 + 59.99, 300, 500, 200)
+    engine.add_sample(T0 + 60, 0, 0, 0)
+
+    closed, current = rows(engine, "minute")
+    assert closed[1:3] == (T0, 2)
+    # grid mean, min, max
+    assert closed[3:6] == (200, 100, 300)
+    assert current[1:3] == (T0 + 60, 1)
+
+
+def test_rollup_integrates_energy_within_max_gap():
+    engine = RollupEngine(max_gap=60)
+    # importing 3600 W for 10 s, then a gap longer than max_gap
+    engine.add_sample(T0, -3600, 0, 3600)
+    engine.add_sample(T0 + 10, 1800, 3600, 1800)
+    engine.add_sample(T0 + 200, 0, 0, 0)
+
+    (hour,) = rows(engine, "hour")
+    values = dict(zip(("import_wh", "export_wh", "self_wh"), hour[12:15]))
+    assert values["import_wh"] == pytest.approx(10)
+    assert values["export_wh"] == 0
+    assert values["self_wh"] == 0
+
+
+def test_rollup_ignores_late_samples():
+    engine = RollupEngine(max_gap=300)
+    engine.add_sample(T0 + 120, 0, 0, 0)
+    engine.add_sample(T0 + 10, 0, 0, 0)
+
+    (minute,) = rows(engine, "minute")
+    assert minute[1:3] == (T0 + 120, 1)
+
+
+def test_rollup_tracks_state_time():
+    engine = RollupEngine(max_gap=300)
+    engine.set_state(State.RELAY_ON.name)
+    engine.add_sample(T0, 0, 0, 0)
+    engine.add_sample(T0 + 30, 0, 0, 0)
+
+    (minute,) = rows(engine, "minute")
+    state_time = dict(zip((s.name for s in State), minute[15:]))
+    assert state_time["RELAY_ON"] == 30
+    assert state_time["STANDBY"] == 0
+
+
+def test_rollups_resume_after_restart(tmp_path):
+    filename = tmp_path / "history.db"
+    store = SampleStore(filename, SysConfig())
+    store.add_sample(sample(T0 + 1, grid=100))
+    store.add_sample(sample(T0 + 2, grid=200))
+    store.stop()
+
+    store = SampleStore(filename, SysConfig())
+    store.add_sample(sample(T0 + 3, grid=600))
+    store.flush()
+    (minute,) = store.get_rollups("minute", T0, T0 + 60)
+    store.stop()
+
+    assert minute["n"] == 3
+    assert minute["grid_mean"] == pytest.approx(300)
+    assert (minute["grid_min"], minute["grid_max"]) == (100, 600)
+
+
+def test_get_samples_is_half_open(store):
+    for i in range(5):
+        store.add_sample(sample(T0 + i, grid=i))
+    store.flush()
+
+    assert [row[1] for row in store.get_samples(T0 + 1, T0 + 4)] == [1, 2, 3]
+
+
+def test_raw_history_keeps_spikes(store):
+    for i in range(100):
+        store.add_sample(sample(T0 + i, grid=5000 if i == 42 else 0))
+    store.flush()
+
+    history = store.get_history(T0, T0 + 100, points=10, res="raw")
+    assert history["resolution"] == "raw"
+    assert history["ts"] == [T0 + 10 * i for i in range(10)]
+    assert history["grid_max"][4] == 5000
+    assert history["grid_mean"][4] == pytest.approx(500)
+    assert max(history["grid_max"][:4] + history["grid_max"][5:]) == 0
+
+
+def test_auto_resolution_uses_rollups(store):
+    # one sample per minute for three hours
+    for i in range(180):
+        store.add_sample(sample(T0 + 60 * i, grid=i // 60))
+    store.flush()
+
+    history = store.get_history(T0, T0 + 3 * 3600, points=3)
+    assert history["resolution"] == "hour"
+    assert history["ts"] == [T0, T0 + 3600, T0 + 7200]
+    assert history["grid_mean"] == [0, 1, 2]
+
+    history = store.get_history(T0, T0 + 3 * 3600, points=36)
+    assert history["resolution"] == "minute"
+    assert len(history["ts"]) == 36
+
+
+def test_empty_history(store):
+    history = store.get_history(T0, T0 + 60)
+
+    assert history["ts"] == []
+    assert history["grid_mean"] == []
+
+
+def test_states_are_stored(store):
+    store.add_state(State.ALARM_ON, ts=T0)
+    store.flush()
+
+    assert store.get_states(T0, T0 + 1) == [(T0, "ALARM_ON")]
+
+
+def test_duplicate_samples_are_dropped(store):
+    store.add_sample(sample(T0, grid=100))
+    store.add_sample(sample(T0, grid=100))
+    store.add_sample(sample(T0 + 1, grid=100))
+    store.flush()
+
+    assert store.duplicates == 1
+    assert len(store.get_samples(T0, T0 + 2)) == 2
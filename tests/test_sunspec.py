@@ -0,0 +1,102 @@
+import pytest
+
+from lib.sunspec import INVERTER, METER, Point, plan_reads
+
+
+
+def registers(model, **values) -> list[int]:
+    """
+    Register image of a model with the given points set, all other points
+    zero. Negative values are stored in two's complement.
+    """
+    regs = [0] * model.size
+    for point in model.points:
+        if point.name not in values:
+            continue
+        value = values[point.name]
+        if point.kind in ("int32", "uint32", "acc32", "bitfield32"):
+            value &= 0xFFFFFFFF
+            regs[point.address] = value >> 16
+            regs[point.address + 1] = value & 0xFFFF
+        else:
+            regs[point.address] = value & 0xFFFF
+    return regs
+
+
+
+def test_plan_reads_merges_small_gaps():
+    points = [Point("a", 10), Point("b", 12, "int32"), Point("c", 40)]
+    blocks = plan_reads(points, max_gap=2)
+
+    assert [(b.address, b.count) for b in blocks] == [(10, 4), (40, 1)]
+    assert [p.name for p in blocks[0].points] == ["a", "b"]
+
+
+def test_plan_reads_sorts_and_respects_span():
+    points = [Point(str(a), a) for a in (30, 0, 10, 20)]
+    blocks = plan_reads(points, max_gap=16, max_span=15)
+
+    assert [(b.address, b.count) for b in blocks] == [(0, 11), (20, 11)]
+
+
+def test_plan_reads_caps_span_at_modbus_limit():
+    blocks = plan_reads([Point("a", 0), Point("b", 200)], max_gap=500,
+                        max_span=1000)
+
+    assert len(blocks) == 2
+
+
+def test_decode_applies_scale_factors():
+    regs = registers(INVERTER, ID=103, W=12345, W_SF=-1, Hz=5001,
+                     Hz_SF=-2, WH=70000, WH_SF=0, St=4)
+    record = INVERTER.decode(regs)
+
+    assert record.W == pytest.approx(1234.5)
+    assert record.Hz == pytest.approx(50.01)
+    assert record.WH == 70000
+    assert record.St == 4
+
+
+def test_decode_signed_values():
+    regs = registers(METER, ID=203, W=-500, W_SF=0)
+
+    assert METER.decode(regs).W == -500
+
+
+def test_decode_not_implemented_is_none():
+    regs = registers(INVERTER, ID=103, W=-0x8000, W_SF=0, Hz=0xFFFF,
+                     Hz_SF=0, WH=0, WH_SF=0)
+    record = INVERTER.decode(regs)
+
+    assert record.W is None
+    assert record.Hz is None
+    # an accumulator of 0 is "not implemented"
+    assert record.WH is None
+
+
+def test_decode_invalid_scale_factor_drops_its_group():
+    regs = registers(INVERTER, ID=103, W=1000, W_SF=-0x8000, Hz=5000,
+                     Hz_SF=-2)
+    record = INVERTER.decode(regs)
+
+    assert record.W is None
+    assert record.Hz == pytest.approx(50.0)
+
+    regs = registers(INVERTER, ID=103, W=1000, W_SF=42)
+    assert INVERTER.decode(regs).W is None
+
+
+def test_decode_rejects_short_blocks_and_unknown_models():
+    regs = registers(INVERTER, ID=103)
+
+    assert INVERTER.decode(regs[:-1]) is None
+    assert INVERTER.decode(registers(INVERTER, ID=203)) is None
+    assert METER.decode(registers(METER, ID=103)) is None
+
+
+def test_points_at_offsets_addresses():
+    points = METER.points_at(188)
+
+    assert points[0].address == 188
+    assert [p.address - 188 for p in points] == [
+        p.address for p in METER.points]
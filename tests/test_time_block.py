@@ -0,0 +1,134 @@
+import time
+from datetime import date
+
+import pytest
+
+from lib.core import TimeBlock
+from lib.utils import TariffConfig, load_tariff_config
+
+
+
+@pytest.fixture(autouse=True)
+def ljubljana(monkeypatch):
+    """
+    Run every test in the local time of the tariff, with DST.
+    """
+    monkeypatch.setenv("TZ", "Europe/Ljubljana")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def tb() -> TimeBlock:
+    return TimeBlock(load_tariff_config("tariffs/si.json"))
+
+
+def local(*args) -> float:
+    """
+    Unix time of a local date and time (year, month, day, hour, minute).
+    """
+    args += (0,) * (5 - len(args))
+    return time.mktime((*args, 0, 0, 0, -1))
+
+
+def utc_hour(ts: float) -> int:
+    return time.gmtime(ts).tm_hour
+
+
+
+@pytest.mark.parametrize("year, easter", [
+    (2000, date(2000, 4, 23)),
+    (2024, date(2024, 3, 31)),
+    (2025, date(2025, 4, 20)),
+    (2026, date(2026, 4, 5)),
+    (2038, date(2038, 4, 25))
+])
+def test_easter(year, easter):
+    assert TimeBlock.easter(year) == easter
+
+
+@pytest.mark.parametrize("when, block", [
+    ((2026, 1, 14, 8), 1),    # high season workday, 7 - 14
+    ((2026, 1, 14, 22, 30), 3),
+    ((2026, 1, 17, 8), 2),    # Saturday
+    ((2026, 7, 15, 3), 4),    # low season workday, night
+    ((2026, 12, 25, 8), 2),   # fixed holiday on a Friday
+    ((2026, 4, 6, 8), 3),     # Easter Monday
+    ((2026, 4, 7, 8), 2)      # the day after is a workday again
+])
+def test_get_time_block(tb, when, block):
+    assert tb.get_time_block(local(*when)) == block
+
+
+def test_next_transition_within_day(tb):
+    assert tb.next_transition(local(2026, 1, 14, 6, 30)) == local(
+        2026, 1, 14, 7)
+    # block 2 from 14 to 16, block 1 from 16 to 20
+    assert tb.next_transition(local(2026, 1, 14, 15)) == local(
+        2026, 1, 14, 16)
+
+
+def test_next_transition_at_year_end(tb):
+    ts = local(2025, 12, 31, 23, 30)
+
+    assert tb.get_time_block(ts) == 3
+    assert tb.next_transition(ts) == local(2026, 1, 1)
+    assert tb.get_time_block(local(2026, 1, 1)) == 4
+
+
+def test_dst_start(tb):
+    # clocks jump from 02:00 to 03:00, the next change is at 06:00 CEST
+    change = tb.next_transition(local(2026, 3, 29, 1, 30))
+
+    assert change == local(2026, 3, 29, 6)
+    assert utc_hour(change) == 4
+
+
+def test_dst_end(tb):
+    # clocks go back from 03:00 to 02:00, the next change is at 06:00 CET
+    change = tb.next_transition(local(2026, 10, 25, 1, 30))
+
+    assert change == local(2026, 10, 25, 6)
+    assert utc_hour(change) == 5
+
+
+def test_update_needed(tb, monkeypatch):
+    now = local(2026, 1, 14, 8)
+    monkeypatch.setattr(time, "time", lambda: now)
+
+    assert tb.update_needed()
+    assert tb.get_time_block() == 1
+    assert not tb.update_needed()
+
+    now = local(2026, 1, 14, 14)
+    assert tb.update_needed()
+
+
+def test_tables_keep_neighbouring_years(tb):
+    for year in (2020, 2021, 2026):
+        tb.get_time_block(local(year, 6, 1))
+
+    assert 2020 not in tb._tables
+    assert 2026 in tb._tables
+
+
+@pytest.mark.parametrize("zones", [[12, 0], [0, 6, 6]])
+def test_unsorted_zones_are_rejected(zones):
+    with pytest.raises(ValueError, match="ascending"):
+        TariffConfig(zones=zones, blocks={
+            "all": {"workday": [1] * len(zones), "free": [1] * len(zones)}})
+
+
+@pytest.mark.parametrize("change", [
+    {"zones": [6, 12]},
+    {"seasons": {"all": list(range(1, 12))}},
+    {"blocks": {"all": {"workday": [1, 2], "free": [1]}}},
+    {"blocks": {"all": {"workday": [0], "free": [1]}}}
+])
+def test_invalid_tariff(change):
+    tariff = TariffConfig(**change)
+
+    with pytest.raises(ValueError):
+        TimeBlock(tariff)
@@ -2,9 +2,11 @@ import os
 import sys
 from pathlib import Path
 import asyncio
+import time
+from array import array
 
-from fastapi import FastAPI, WebSocket
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, WebSocket, Query, HTTPException
+from fastapi.responses import HTMLResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 
@@ -72,28 +74,129 @@ async def update_config(data: lib.Config) -> None:
     print("Updating configs")
     match data.sys.mode:
         case "Standalone":
-            lib.update_config(data.sys)
-            lib.update_config(data.modbus)
+            configs = (data.sys, data.modbus)
         case "Simulator":
-            lib.update_config(data.sys)
+            configs = (data.sys,)
         case "Subscriber":
-            lib.update_config(data.sys)
-            lib.update_config(data.mqtt)
+            configs = (data.sys, data.mqtt)
         case "Publisher":
-            lib.update_config(data.modbus)
-            lib.update_config(data.mqtt)
+            configs = (data.modbus, data.mqtt)
         case _:
+            configs = ()
             print(f"Failed to update anything. Received: {data.sys.mode}")
-            
-    await task.cancel_task()
-    await task.do_new_task(data.sys.mode)
+
+    # the fsyncs can take a while on an SD card, keep them off the loop
+    for config in configs:
+        await asyncio.to_thread(lib.update_config, config)
+
+    config = lib.Config(sys=lib.load_sys_config(),
+                        mqtt=lib.load_mqtt_config(),
+                        modbus=lib.load_modbus_config())
+    await task.apply_config(data.sys.mode, config)
+
+
+
+@app.get("/history")
+async def get_history(
+        start: float | None = Query(None, alias="from"),
+        end: float | None = Query(None, alias="to"),
+        resolution: str = "auto",
+        points: int = Query(500, ge=1, le=10000),
+        format: str = "json"):
+    """
+    Return the stored power history between from and to (unix time, default
+    is the last 24 hours) downsampled to at most points buckets.
+
+    :param resolution: raw, minute, hour, day or auto.
+    :param format: json returns columns as lists. binary returns the columns
+        as little endian arrays, ts as float64 and the rest as float32. The
+        column names and length are sent in the X-Columns and X-Count
+        headers.
+    """
+    store = task.store
+    if store is None:
+        raise HTTPException(404, "History is not available in this mode")
+
+    end = time.time() if end is None else end
+    start = end - 86400 if start is None else start
+
+    try:
+        history = await asyncio.to_thread(
+            store.get_history, start, end, points, resolution)
+    except ValueError as err:
+        raise HTTPException(400, str(err))
+
+    if format != "binary":
+        return history
+
+    columns = [key for key in history if key != "resolution"]
+    payload = bytearray()
+    for key in columns:
+        values = array("d" if key == "ts" else "f",
+                       (v if v is not None else float("nan")
+                        for v in history[key]))
+        if sys.byteorder != "little":
+            values.byteswap()
+        payload += values.tobytes()
+
+    return Response(bytes(payload), media_type="application/octet-stream",
+                    headers={
+                        "X-Resolution": history["resolution"],
+                        "X-Columns": ",".join(columns),
+                        "X-Count": str(len(history["ts"]))})
+
+
+
+@app.get("/clients")
+async def get_clients() -> list[dict]:
+    """
+    Return the per websocket broadcast stats (frames sent, dropped, queued
+    and the lag of the last frame in seconds).
+    """
+    return task.client_stats()
+
+
+
+@app.get("/latency")
+async def get_latency() -> dict:
+    """
+    Return the latency histograms (seconds from acquisition until the sample
+    passed each hop) as cumulative bucket counts.
+    """
+    return {hop: h.snapshot() for hop, h in lib.LATENCY.items()}
+
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """
+    Return loop, acquisition, relay and MQTT metrics in the Prometheus text
+    exposition format.
+    """
+    return Response(task.metrics(), media_type=lib.MetricsWriter.CONTENT_TYPE)
+
+
+
+@app.get("/status")
+async def get_status() -> dict:
+    """
+    Return the running mode and whether its connections are up. Connections
+    are made in the background, so a mode runs before it is ready.
+    """
+    return task.status()
 
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    task.add_socket(websocket)
+    protocol = None
+    for name in websocket.scope.get("subprotocols", []):
+        if name in lib.SUBPROTOCOLS:
+            protocol = name
+            break
+
+    await websocket.accept(subprotocol=protocol)
+    task.add_socket(websocket, protocol)
 
     try:
         while True:
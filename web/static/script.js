@@ -1,9 +1,13 @@
 let currentMode;
 let isManual = false;
+let dashboardData = {};
+// last loaded config, keeps the fields without an input when saving
+let loadedConfig = {sys: {}, modbus: {}, mqtt: {}};
 var ws = new WebSocket(
   (location.protocol === "https:" ? "wss://" : "ws://") +
   location.host +
-  "/ws"
+  "/ws",
+  ["solar.delta"]
 );
 
 ws.onopen = () => console.log("WebSocket connected");
@@ -122,7 +126,11 @@ function populateConfigDiv(prefix, data, container) {
             const input = div.querySelector("input");
             if (!input) continue;
 
-            input.value = value;
+            if (input.type === "checkbox") {
+                input.checked = value;
+            } else {
+                input.value = value;
+            }
         }
     } catch (error) {
         console.error(error.message);
@@ -133,6 +141,7 @@ function populateConfigDiv(prefix, data, container) {
 async function loadConfig() {
     const config = await getConfig();
     if (!config) return;
+    loadedConfig = config;
 
     // console.log(config);
     const sysContainer = document.getElementById("sys-config");
@@ -188,9 +197,9 @@ function loadManual(config) {
 
 async function sendConfig() {
     const payload = {
-        sys: {},
-        modbus: {},
-        mqtt: {}
+        sys: {...loadedConfig.sys},
+        modbus: {...loadedConfig.modbus},
+        mqtt: {...loadedConfig.mqtt}
     };
 
     const sysContainer = document.getElementById("sys-config");
@@ -246,7 +255,8 @@ function get_input_value(element, data) {
 
 
 ws.onmessage = function(event) {
-    const data = JSON.parse(event.data);
+    // solar.delta frames only contain the fields that changed
+    const data = Object.assign(dashboardData, JSON.parse(event.data));
 
     const container = document.getElementById("screen-dashboard");
     container.querySelector("#house-label").textContent = data.load;